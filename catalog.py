@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# catalog.py - triage many MP4 (INSV) files by their top-level atoms
+#
+# only the headers of the top-level atoms and the tail of each file are read,
+# and each file is classified as
+#   healthy        : 'moov' is found
+#   missing_moov   : 'mdat' without 'moov' (including 'mdat' of size 0)
+#   zero_tail      : 'mdat' without 'moov', and the file ends with zeros
+#                    (blocks which were never written)
+#   truncated_mdat : 'mdat' extends beyond the end of file
+#   unknown        : no 'mdat' is found
+import concurrent.futures
+import csv
+import json
+import os
+import os.path
+import struct
+import sys
+
+
+EXTENSIONS = ('.mp4', '.insv')
+
+# bytes at the end of file to be checked for zeros
+TAIL_SIZE = 65536
+
+# a tail with this many zeros is regarded as never written
+MIN_ZERO_TAIL = 4096
+
+FIELDS = ('path', 'size', 'status', 'mdat_offset', 'mdat_size', 'moov_offset', 'zero_tail')
+
+
+def classify_file(filename, tail_size=TAIL_SIZE):
+    file_size = os.path.getsize(filename)
+    entry = {
+        'path': filename,
+        'size': file_size,
+        'status': 'unknown',
+        'mdat_offset': None,
+        'mdat_size': None,
+        'moov_offset': None,
+        'zero_tail': 0,
+    }
+
+    truncated = False
+    with open(filename, 'rb') as f:
+        cur = 0
+        while cur + 8 <= file_size:
+            f.seek(cur)
+            buf = f.read(16)
+            n = struct.unpack('>I', buf[:4])[0]
+            atom_type = buf[4:8]
+            if n == 1 and len(buf) == 16:
+                n = struct.unpack('>Q', buf[8:16])[0]
+
+            if atom_type == b'mdat':
+                entry['mdat_offset'] = cur
+                entry['mdat_size'] = n
+            elif atom_type == b'moov':
+                entry['moov_offset'] = cur
+
+            if n == 0:
+                # to the end of file, as 'mdat' of the incomplete recording
+                break
+            if n < 8:
+                # broken atom
+                break
+            if cur + n > file_size:
+                truncated = True
+                break
+            cur += n
+
+        tail = min(tail_size, file_size)
+        f.seek(file_size - tail)
+        buf = f.read(tail)
+        entry['zero_tail'] = len(buf) - len(buf.rstrip(b'\x00'))
+
+    if entry['moov_offset'] is not None and not truncated:
+        entry['status'] = 'healthy'
+    elif entry['mdat_offset'] is None:
+        entry['status'] = 'unknown'
+    elif truncated:
+        entry['status'] = 'truncated_mdat'
+    elif entry['zero_tail'] >= MIN_ZERO_TAIL:
+        entry['status'] = 'zero_tail'
+    else:
+        entry['status'] = 'missing_moov'
+
+    return entry
+
+
+def list_files(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(EXTENSIONS):
+                        filenames.append(os.path.join(root, name))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def catalog(paths, max_workers=16):
+    # the header reads are overlapped across the files
+    filenames = list_files(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(classify_file, filenames))
+
+
+def write_catalog(entries, f_out, output_format='json'):
+    if output_format == 'csv':
+        writer = csv.DictWriter(f_out, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(entries)
+    else:
+        json.dump(entries, f_out, indent=2)
+        f_out.write('\n')
+
+
+def usage():
+    print('catalog.py : to classify MP4 (insv) files by their top-level atoms')
+    print('USAGE: catalog.py [options] file_or_dir [file_or_dir ...]')
+    print('\t-f fmt  : output format, json (default) or csv')
+    print('\t-o file : output file (default stdout)')
+    print('\t-j n    : number of files read at the same time (default 16)')
+    sys.exit()
+
+
+if __name__ == '__main__':
+    output_format = 'json'
+    output_filename = None
+    max_workers = 16
+    paths = []
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '-f':
+            output_format = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-o':
+            output_filename = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-j':
+            max_workers = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i].startswith('-'):
+            usage()
+        else:
+            paths.append(sys.argv[i])
+            i += 1
+
+    if len(paths) == 0 or output_format not in ('json', 'csv'):
+        usage()
+
+    entries = catalog(paths, max_workers)
+    if output_filename is None:
+        write_catalog(entries, sys.stdout, output_format)
+    else:
+        with open(output_filename, 'w', newline='') as f_out:
+            write_catalog(entries, f_out, output_format)
+
+    counts = {}
+    for entry in entries:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    print(', '.join(f'{status}: {n}' for status, n in sorted(counts.items())), file=sys.stderr)
@@ -18,142 +18,216 @@ def parse_box(f):
     return box_size, box_type
 
 
-def main(filename_in):
+def read_sample_tables(f_in, file_size):
+    # walk the box tree and collect the sample tables of each trak
+    # returns a list of dicts, one for each trak in order
     containers = ('moov', 'trak', 'edts', 'mdia', 'minf', 'dinf', 'stbl')
 
-    with open(filename_in, 'rb') as f_in:
-        f_in.seek(0, 2)
-        file_size = f_in.tell()
-
-        cur = 0
-        sc_table = []
-        sz_table = []
-        co_table = []
-        while True:
-            f_in.seek(cur)
-
-            box_size, box_type = parse_box(f_in)
-            if box_size == 0:
-                box_size = file_size - cur
-
-            if box_type in containers:
-                box_size, box_type = parse_box(f_in)
-                if box_size == 0:
-                    box_size = file_size - cur
-                cur += 8
-            elif box_type == 'stsc':
-                # Sample-to-Chunk Atoms
-                buf = f_in.read(box_size - 8)
-
-                version   = buf[0]
-                flags     = buf[1:4]
-                n_entries = struct.unpack('>I', buf[4:8])[0]
-
-                for i in range(n_entries):
-                    i0 = 8 + i*12
-                    i1 = i0 + 12
-                    if len(buf) < i1: break
-                    first_chunk       = struct.unpack('>I', buf[i0:i0+4])[0]
-                    samples_per_chunk = struct.unpack('>I', buf[i0+4:i0+8])[0]
-                    sample_desc_id    = struct.unpack('>I', buf[i0+8:i0+12])[0]
-                    sc_table.append((first_chunk, samples_per_chunk, sample_desc_id))
-                    # print(f'{i:6d}: {(first_chunk, samples_per_chunk, sample_desc_id)}')
-            elif box_type == 'stsz':
-                #Sample Size Atoms
-                buf = f_in.read(box_size - 8)
-
-                version   = buf[0]
-                flags     = buf[1:4]
-                sample_size = struct.unpack('>I', buf[4:8])[0]
-                n_entries = struct.unpack('>I', buf[8:12])[0]
-
+    tracks = []
+    track = None
+
+    cur = 0
+    while cur < file_size:
+        f_in.seek(cur)
+
+        box_size, box_type = parse_box(f_in)
+        if box_size == 0:
+            box_size = file_size - cur
+
+        if box_type in containers:
+            if box_type == 'trak':
+                track = {
+                    'handler': None,
+                    'timescale': None,
+                    'stsd': None,
+                    'ts_table': [],
+                    'ss_table': None,
+                    'sc_table': [],
+                    'sz_table': [],
+                    'co_table': [],
+                }
+                tracks.append(track)
+            # descend into the sub boxes
+            cur += 8
+            continue
+        elif track is None:
+            pass
+        elif box_type == 'hdlr':
+            # Handler Reference Atoms
+            buf = f_in.read(box_size - 8)
+
+            component_type    = buf[4:8]
+            component_subtype = str(buf[8:12], 'latin-1')
+            # skip the data handler ('dhlr') in minf
+            if component_type != b'dhlr' and track['handler'] is None:
+                track['handler'] = component_subtype
+        elif box_type == 'mdhd':
+            # Media Header Atoms
+            buf = f_in.read(box_size - 8)
+
+            version = buf[0]
+            if version == 1:
+                track['timescale'] = struct.unpack('>I', buf[20:24])[0]
+            else:
+                track['timescale'] = struct.unpack('>I', buf[12:16])[0]
+        elif box_type == 'stts':
+            # Time-to-Sample Atoms
+            buf = f_in.read(box_size - 8)
+
+            version   = buf[0]
+            flags     = buf[1:4]
+            n_entries = struct.unpack('>I', buf[4:8])[0]
+
+            for i in range(n_entries):
+                i0 = 8 + i*8
+                i1 = i0 + 8
+                if len(buf) < i1: break
+                sample_count    = struct.unpack('>I', buf[i0:i0+4])[0]
+                sample_duration = struct.unpack('>I', buf[i0+4:i1])[0]
+                track['ts_table'].append((sample_count, sample_duration))
+        elif box_type == 'stss':
+            # Sync Sample Atoms
+            buf = f_in.read(box_size - 8)
+
+            version   = buf[0]
+            flags     = buf[1:4]
+            n_entries = struct.unpack('>I', buf[4:8])[0]
+
+            track['ss_table'] = []
+            for i in range(n_entries):
+                i0 = 8 + i*4
+                i1 = i0 + 4
+                if len(buf) < i1: break
+                track['ss_table'].append(struct.unpack('>I', buf[i0:i1])[0])
+        elif box_type == 'stsd':
+            # Sample Description Atoms
+            buf = f_in.read(box_size - 8)
+            track['stsd'] = buf
+        elif box_type == 'stsc':
+            # Sample-to-Chunk Atoms
+            buf = f_in.read(box_size - 8)
+
+            version   = buf[0]
+            flags     = buf[1:4]
+            n_entries = struct.unpack('>I', buf[4:8])[0]
+
+            for i in range(n_entries):
+                i0 = 8 + i*12
+                i1 = i0 + 12
+                if len(buf) < i1: break
+                first_chunk       = struct.unpack('>I', buf[i0:i0+4])[0]
+                samples_per_chunk = struct.unpack('>I', buf[i0+4:i0+8])[0]
+                sample_desc_id    = struct.unpack('>I', buf[i0+8:i0+12])[0]
+                track['sc_table'].append((first_chunk, samples_per_chunk, sample_desc_id))
+        elif box_type == 'stsz':
+            #Sample Size Atoms
+            buf = f_in.read(box_size - 8)
+
+            version   = buf[0]
+            flags     = buf[1:4]
+            sample_size = struct.unpack('>I', buf[4:8])[0]
+            n_entries = struct.unpack('>I', buf[8:12])[0]
+
+            if sample_size != 0:
+                track['sz_table'] = [sample_size] * n_entries
+            else:
                 for i in range(n_entries):
                     i0 = 12 + i*4
                     i1 = i0 + 4
                     if len(buf) < i1: break
                     size = struct.unpack('>I', buf[i0:i1])[0]
-                    sz_table.append(size)
-                    # print(f'{i:6d}: {size}')
-            elif box_type == 'stco':
-                #Chunk Offset Atoms
-                buf = f_in.read(box_size - 8)
-
-                version   = buf[0]
-                flags     = buf[1:4]
-                n_entries = struct.unpack('>I', buf[4:8])[0]
+                    track['sz_table'].append(size)
+        elif box_type == 'stco':
+            #Chunk Offset Atoms
+            buf = f_in.read(box_size - 8)
+
+            version   = buf[0]
+            flags     = buf[1:4]
+            n_entries = struct.unpack('>I', buf[4:8])[0]
+
+            for i in range(n_entries):
+                i0 = 8 + i*4
+                i1 = i0 + 4
+                if len(buf) < i1: break
+                offset = struct.unpack('>I', buf[i0:i1])[0]
+                track['co_table'].append(offset)
+        elif box_type == 'co64':
+            #64-bit chunk offset atoms
+            buf = f_in.read(box_size - 8)
+
+            version   = buf[0]
+            flags     = buf[1:4]
+            n_entries = struct.unpack('>I', buf[4:8])[0]
+
+            for i in range(n_entries):
+                i0 = 8 + i*8
+                i1 = i0 + 8
+                if len(buf) < i1: break
+                offset = struct.unpack('>Q', buf[i0:i1])[0]
+                track['co_table'].append(offset)
+
+        cur += box_size
+
+    return tracks
+
+
+def iter_samples(sc_table, sz_table, co_table):
+    # expand stsc/stco/stsz into (offset, size) of each sample
+    i = 0
+    l = 0
+    while True:
+        m0, n, _ = sc_table[i]
+        if i + 1 < len(sc_table):
+            m1 = sc_table[i + 1][0]
+        else:
+            m1 = len(co_table) + 1
+
+        j = m0 - 1
+        while True:
+            offset = co_table[j]
 
-                for i in range(n_entries):
-                    i0 = 8 + i*4
-                    i1 = i0 + 4
-                    if len(buf) < i1: break
-                    offset = struct.unpack('>I', buf[i0:i1])[0]
-                    co_table.append(offset)
-                    # print(f'{i:6d}: {offset}')
-            elif box_type == 'co64':
-                #64-bit chunk offset atoms
-                buf = f_in.read(box_size - 8)
+            k = 0
+            while True:
+                if l >= len(sz_table): return
+                yield offset, sz_table[l]
+                offset += sz_table[l]
+                l += 1
 
-                version   = buf[0]
-                flags     = buf[1:4]
-                n_entries = struct.unpack('>I', buf[4:8])[0]
+                k += 1
+                if k >= n:
+                    break
 
-                for i in range(n_entries):
-                    i0 = 8 + i*8
-                    i1 = i0 + 8
-                    if len(buf) < i1: break
-                    offset = struct.unpack('>Q', buf[i0:i1])[0]
-                    co_table.append(offset)
-                    # print(f'{i:6d}: {offset}')
-
-            if len(sc_table) != 0 and len(sz_table) != 0 and len(co_table) != 0:
-                print('########################            ########################')
-                i = 0
-                l = 0
-                while True:
-                    m0, n, _ = sc_table[i]
-                    if i + 1 < len(sc_table):
-                        m1 = sc_table[i + 1][0]
-                    else:
-                        m1 = len(co_table) + 1
-
-                    j = m0 - 1
-                    while True:
-                        offset = co_table[j]
-
-                        k = 0
-                        while True:
-                            cur_temp = f_in.tell()
-                            f_in.seek(offset)
-                            buf = bytes([0x00, 0x00]) + f_in.read(6)
-                            f_in.seek(cur_temp)
-                            binary = struct.unpack('>Q', buf)[0]
-                            mark = ' '
-                            if sz_table[l] < 100: mark = 'v'
-                            print(f'{mark}{offset:10d} {sz_table[l]:6d} {binary:059_b}')
-                            offset += sz_table[l]
-                            l += 1
-
-                            k += 1
-                            if k >= n:
-                                break
-
-                        j += 1
-                        if j >= m1 - 1:
-                            break
-
-                    i += 1
-                    if i >= len(sc_table):
-                        break
-                print('')
-
-                sc_table = []
-                sz_table = []
-                co_table = []
-
-            cur += box_size
-            if cur >= file_size:
+            j += 1
+            if j >= m1 - 1:
                 break
 
+        i += 1
+        if i >= len(sc_table):
+            break
+
+
+def main(filename_in):
+    with open(filename_in, 'rb') as f_in:
+        f_in.seek(0, 2)
+        file_size = f_in.tell()
+
+        for track in read_sample_tables(f_in, file_size):
+            sc_table = track['sc_table']
+            sz_table = track['sz_table']
+            co_table = track['co_table']
+            if len(sc_table) == 0 or len(sz_table) == 0 or len(co_table) == 0:
+                continue
+
+            print('########################            ########################')
+            for offset, size in iter_samples(sc_table, sz_table, co_table):
+                f_in.seek(offset)
+                buf = bytes([0x00, 0x00]) + f_in.read(6)
+                binary = struct.unpack('>Q', buf)[0]
+                mark = ' '
+                if size < 100: mark = 'v'
+                print(f'{mark}{offset:10d} {size:6d} {binary:059_b}')
+            print('')
+
 
 if __name__ == '__main__':
     if len(sys.argv) != 2:
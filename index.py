@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# index.py - look up the samples by sample number or time in O(log n)
+#
+# the cumulative arrays are built once from stts/stsc/stco/stsz of a trak,
+# or from the sample tables recovered from mdat, and the queries are
+# answered by the binary search over them.
+# the sample numbers are 1-based as in stss.
+import array
+import bisect
+import itertools
+import sys
+
+from chunk import read_sample_tables
+
+
+class SampleIndex:
+    def __init__(self, sc_table, sz_table, co_table, ts_table, timescale, sync=None):
+        # sc_table : [(first_chunk, samples_per_chunk, sample_desc_id)]
+        # sz_table : [size]
+        # co_table : [offset of chunk]
+        # ts_table : [(sample_count, sample_duration)]
+        # sync     : [sync sample number], or None if all samples are sync
+        self.n_samples = len(sz_table)
+        self.timescale = timescale
+        self.sync = sync
+
+        # the first sample (0-based) of each chunk
+        self.chunk_offsets = array.array('Q', co_table)
+        self.chunk_first = array.array('Q')
+        first = 0
+        for i, (first_chunk, samples_per_chunk, _) in enumerate(sc_table):
+            if i + 1 < len(sc_table):
+                next_chunk = sc_table[i+1][0]
+            else:
+                next_chunk = len(co_table) + 1
+            for _ in range(first_chunk, next_chunk):
+                self.chunk_first.append(first)
+                first += samples_per_chunk
+
+        # sizes and their cumulative sums, for the offsets within a chunk
+        self.sizes = array.array('I', sz_table)
+        self.size_sums = array.array('Q', itertools.accumulate(sz_table, initial=0))
+
+        # the first sample (0-based) and its time of each run of stts
+        self.run_first = array.array('Q')
+        self.run_time = array.array('Q')
+        self.run_delta = array.array('I')
+        first = 0
+        time = 0
+        for sample_count, sample_duration in ts_table:
+            if sample_count == 0: continue
+            self.run_first.append(first)
+            self.run_time.append(time)
+            self.run_delta.append(sample_duration)
+            first += sample_count
+            time += sample_count * sample_duration
+
+    @classmethod
+    def from_track(cls, track):
+        # track is from chunk.read_sample_tables()
+        return cls(
+            track['sc_table'],
+            track['sz_table'],
+            track['co_table'],
+            track['ts_table'],
+            track['timescale'],
+            track['ss_table'])
+
+    @classmethod
+    def from_recovered(cls, table, sample_duration, timescale, sync=None):
+        # table is [(offset, size)] recovered from mdat,
+        # where each sample is a chunk as in the rebuilt moov
+        return cls(
+            [(1, 1, 1)],
+            [size for _, size in table],
+            [offset for offset, _ in table],
+            [(len(table), sample_duration)],
+            timescale,
+            sync)
+
+    def sample(self, number):
+        # returns (offset, size) of the sample
+        i = number - 1
+        if i < 0 or i >= self.n_samples: raise IndexError(f'sample {number} is out of range')
+        chunk = bisect.bisect_right(self.chunk_first, i) - 1
+        offset = self.chunk_offsets[chunk] + self.size_sums[i] - self.size_sums[self.chunk_first[chunk]]
+        return offset, self.sizes[i]
+
+    def time(self, number):
+        # returns the decoding time of the sample in seconds
+        i = number - 1
+        run = bisect.bisect_right(self.run_first, i) - 1
+        return (self.run_time[run] + (i - self.run_first[run]) * self.run_delta[run]) / self.timescale
+
+    def sample_at(self, seconds):
+        # returns the number of the sample at the time
+        t = int(seconds * self.timescale)
+        run = max(0, bisect.bisect_right(self.run_time, t) - 1)
+        i = self.run_first[run]
+        if self.run_delta[run] > 0:
+            i += (t - self.run_time[run]) // self.run_delta[run]
+        return min(max(i, 0), self.n_samples - 1) + 1
+
+    def keyframe_before(self, number):
+        # the last sync sample at or before the sample
+        if self.sync is None or len(self.sync) == 0: return number
+        k = bisect.bisect_right(self.sync, number) - 1
+        return self.sync[max(k, 0)]
+
+    def keyframe_after(self, number):
+        # the first sync sample at or after the sample
+        if self.sync is None or len(self.sync) == 0: return number
+        k = bisect.bisect_left(self.sync, number)
+        return self.sync[min(k, len(self.sync) - 1)]
+
+    def nearest_keyframe(self, number):
+        before = self.keyframe_before(number)
+        after = self.keyframe_after(number)
+        if abs(after - number) < abs(number - before): return after
+        return before
+
+    def lookup(self, seconds, keyframe=False):
+        # returns (sample number, offset, size) of the sample at the time,
+        # or of the nearest sync sample with keyframe=True
+        number = self.sample_at(seconds)
+        if keyframe:
+            number = self.nearest_keyframe(number)
+        offset, size = self.sample(number)
+        return number, offset, size
+
+
+def load_indexes(filename):
+    # returns [(handler, SampleIndex)] of the tracks of the file
+    indexes = []
+    with open(filename, 'rb') as f_in:
+        f_in.seek(0, 2)
+        file_size = f_in.tell()
+        for track in read_sample_tables(f_in, file_size):
+            if len(track['sz_table']) == 0 or len(track['co_table']) == 0: continue
+            if track['timescale'] is None or len(track['ts_table']) == 0: continue
+            indexes.append((track['handler'], SampleIndex.from_track(track)))
+    return indexes
+
+
+def main(filename_in, times):
+    indexes = load_indexes(filename_in)
+    for seconds in times:
+        for handler, index in indexes:
+            number, offset, size = index.lookup(seconds)
+            print(f'{seconds:10.3f} sec : {handler} sample {number} at {offset} ({size} bytes)', end='')
+            if index.sync is not None:
+                keyframe, key_offset, _ = index.lookup(seconds, keyframe=True)
+                print(f', keyframe {keyframe} at {key_offset}', end='')
+            print('')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(f'Usage: python {sys.argv[0]} in.mp4 seconds [seconds ...]')
+        sys.exit(1)
+
+    filename_in = sys.argv[1]
+    times = [float(x) for x in sys.argv[2:]]
+
+    main(filename_in, times)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# learn.py - derive the scanner profile from a healthy reference file
+#
+# the sample tables (stsc/stco/stsz) of the reference tell exactly where
+# every sample starts, so the bits which never change at the head of the
+# samples of a track can be used as the signature of the track.
+import json
+import mmap
+import os.path
+import statistics
+import sys
+
+from chunk import read_sample_tables, iter_samples
+
+
+# number of bytes at the head of each sample to be learned
+SIGNATURE_LENGTH = 8
+
+# only the first syntax element of AAC frames is the same in any stream
+AUDIO_SIGNATURE_LENGTH = 1
+
+# signatures with less constant bits than this are too weak to scan for
+MIN_SIGNATURE_BITS = 16
+MIN_AUDIO_SIGNATURE_BITS = 7
+
+
+def learn_signature(mm, samples, n_bytes=SIGNATURE_LENGTH, first_nal=False):
+    # value : the head bytes of the first sample
+    # mask  : bits which are same in all samples
+    # with first_nal, only the first NAL unit (AUD) of each video sample is learned,
+    # since the length of the next NAL unit depends on the stream
+    value = None
+    mask = None
+    for offset, size in samples:
+        n = min(n_bytes, size)
+        if first_nal and n >= 4:
+            n = min(n, 4 + int.from_bytes(mm[offset:offset+4], 'big'))
+        head = int.from_bytes(mm[offset:offset+n].ljust(n_bytes, b'\x00'), 'big')
+        head_mask = ((1 << (8*n)) - 1) << (8*(n_bytes - n))
+        if value is None:
+            value = head
+            mask = head_mask
+        else:
+            mask &= ~(value ^ head) & head_mask
+
+    if value is None:
+        return b'', b''
+
+    # drop the trailing bytes without any constant bit
+    n = n_bytes
+    while n > 0 and (mask >> (8*(n_bytes - n))) & 0xFF == 0:
+        n -= 1
+    value = (value & mask) >> (8*(n_bytes - n))
+    mask = mask >> (8*(n_bytes - n))
+
+    return value.to_bytes(n, 'big'), mask.to_bytes(n, 'big')
+
+
+def learn_interleave(track_samples, n_runs=8):
+    # merge the samples of all tracks in the file order, and measure the
+    # runs of consecutive samples of each handler type
+    samples = []
+    for handler, track in track_samples:
+        samples += [(o, s, handler) for o, s in track]
+    samples.sort()
+
+    runs = []
+    for offset, size, handler in samples:
+        if len(runs) > 0 and runs[-1][0] == handler and runs[-1][1] + runs[-1][2] == offset:
+            runs[-1][2] += size
+            runs[-1][3] += 1
+        else:
+            runs.append([handler, offset, size, 1])
+
+    video_runs = [n for handler, _, _, n in runs if handler == 'vide']
+    audio_runs = [size for handler, _, size, _ in runs if handler == 'soun']
+    if len(video_runs) == 0 or len(audio_runs) == 0:
+        return None
+
+    # the most common audio runs in bytes
+    counts = {}
+    for size in audio_runs:
+        counts[size] = counts.get(size, 0) + 1
+    common = sorted(counts.items(), key=lambda x: -x[1])[:n_runs]
+
+    return {
+        'video_samples_per_run': statistics.mode(video_runs),
+        'audio_bytes_per_run': statistics.mean(audio_runs),
+        'audio_run_bytes': [size for size, count in common if count > 1],
+    }
+
+
+def learn_profile(filename):
+    profile = {
+        'reference': os.path.basename(filename),
+        'tracks': [],
+    }
+
+    with open(filename, 'rb') as f_in,        mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        file_size = len(mm)
+
+        track_samples = []
+        for track in read_sample_tables(f_in, file_size):
+            sc_table = track['sc_table']
+            sz_table = track['sz_table']
+            co_table = track['co_table']
+            if len(sc_table) == 0 or len(sz_table) == 0 or len(co_table) == 0:
+                continue
+
+            samples = list(iter_samples(sc_table, sz_table, co_table))
+            track_samples.append((track['handler'], samples))
+            if track['handler'] == 'vide':
+                value, mask = learn_signature(mm, samples, first_nal=True)
+            elif track['handler'] == 'soun':
+                value, mask = learn_signature(mm, samples, AUDIO_SIGNATURE_LENGTH)
+            else:
+                value, mask = learn_signature(mm, samples)
+            sizes = [s for o, s in samples]
+
+            codec = None
+            if track['stsd'] is not None and len(track['stsd']) >= 16:
+                codec = str(track['stsd'][12:16], 'latin-1')
+
+            profile['tracks'].append({
+                'handler': track['handler'],
+                'codec': codec,
+                'n_samples': len(samples),
+                'signature': value.hex(),
+                'mask': mask.hex(),
+                'size_min': min(sizes),
+                'size_max': max(sizes),
+                'size_mean': statistics.mean(sizes),
+                'size_median': statistics.median(sizes),
+                'samples_per_chunk': statistics.mode([n for _, n, _ in sc_table]),
+            })
+
+        interleave = learn_interleave(track_samples)
+        if interleave is not None:
+            profile['interleave'] = interleave
+
+    return profile
+
+
+def signature_bits(mask):
+    return sum(bin(b).count('1') for b in mask)
+
+
+def main(filename_in, filename_out):
+    profile = learn_profile(filename_in)
+
+    for i, track in enumerate(profile['tracks']):
+        mask = bytes.fromhex(track['mask'])
+        print(f'{i}: {track["handler"]} ({track["codec"]}) {track["n_samples"]} samples')
+        print(f'   signature : {track["signature"]} / {track["mask"]} ({signature_bits(mask)} bits)')
+        print(f'   size      : {track["size_min"]} - {track["size_max"]} (mean {track["size_mean"]:.1f})')
+        min_bits = MIN_AUDIO_SIGNATURE_BITS if track['handler'] == 'soun' else MIN_SIGNATURE_BITS
+        if signature_bits(mask) < min_bits:
+            print(f'   WARNING: signature is too weak to scan for')
+
+    if 'interleave' in profile:
+        interleave = profile['interleave']
+        print(f'interleave: {interleave["video_samples_per_run"]} video samples per run, '
+              f'{interleave["audio_bytes_per_run"]:.1f} audio bytes per run')
+
+    with open(filename_out, 'w') as f_out:
+        json.dump(profile, f_out, indent=2)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'Usage: python {sys.argv[0]} ref.mp4 profile.json')
+        sys.exit(1)
+
+    filename_in = sys.argv[1]
+    filename_out = sys.argv[2]
+
+    main(filename_in, filename_out)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# library.py - a library of healthy MP4 (INSV) files as the references
+#
+# each healthy file is indexed by the parameter sets of its video (see mov.py),
+# and the reference for an incomplete file is found by the same parameter sets
+# in its mdat, without trying the references one by one.
+# the library is a JSON file of {key: [entry]}, used by mov.py -L.
+import os.path
+import sys
+
+from catalog import list_files, classify_file
+from mov import (
+    reference_fingerprint,
+    inband_fingerprint,
+    load_reference_library,
+    save_reference_library,
+)
+
+
+def add_references(library, paths):
+    # returns the number of the files added
+    known = set(entry['path'] for entries in library.values() for entry in entries)
+    n_added = 0
+    for filename in list_files(paths):
+        if classify_file(filename)['status'] != 'healthy': continue
+        if os.path.abspath(filename) in known: continue
+        fingerprint = reference_fingerprint(filename)
+        if fingerprint is None: continue
+        key, entry = fingerprint
+        library.setdefault(key, []).append(entry)
+        known.add(entry['path'])
+        n_added += 1
+        print(f'{filename} : {entry["codec"]} {entry.get("width")}x{entry.get("height")}')
+    return n_added
+
+
+def find_references(library, filename):
+    key = inband_fingerprint(filename)
+    if key is None:
+        print(f'{filename} : no parameter sets are found in mdat')
+        return
+    entries = library.get(key, [])
+    if len(entries) == 0:
+        print(f'{filename} : no reference is found')
+        return
+    print(f'{filename} :')
+    for entry in entries:
+        print(f'\t{entry["path"]} ({entry["codec"]} {entry.get("width")}x{entry.get("height")},'
+              f' audio {entry.get("audio")})')
+
+
+def usage():
+    print('library.py : to index healthy MP4 (insv) files as the references')
+    print('USAGE: library.py [options] file_or_dir [file_or_dir ...]')
+    print('\t-b file : library file (default references.json)')
+    print('\t-q      : to look up the references of the incomplete files')
+    print('\t          instead of adding the files to the library')
+    sys.exit()
+
+
+if __name__ == '__main__':
+    library_filename = 'references.json'
+    query = False
+    paths = []
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '-b':
+            library_filename = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-q':
+            query = True
+            i += 1
+        elif sys.argv[i].startswith('-'):
+            usage()
+        else:
+            paths.append(sys.argv[i])
+            i += 1
+
+    if len(paths) == 0:
+        usage()
+
+    if os.path.exists(library_filename):
+        library = load_reference_library(library_filename)
+    elif query:
+        print(f'library file {library_filename} does not exist')
+        sys.exit()
+    else:
+        library = {}
+
+    if query:
+        for filename in list_files(paths):
+            find_references(library, filename)
+    else:
+        n_added = add_references(library, paths)
+        save_reference_library(library_filename, library)
+        print(f'{n_added} files are added, {len(library)} fingerprints in {library_filename}')
@@ -7,10 +7,82 @@
 import sys
 import os.path
 
+import array
+import bisect
+import concurrent.futures
+import json
+import logging
+import math
+import mmap
+import random
+import re
+import statistics
 import struct
+import time
+import urllib.parse
 from datetime import datetime, timedelta
 import gc
-#from tqdm import tqdm
+
+from chunk import read_sample_tables, iter_samples
+from index import SampleIndex
+
+
+# ## logging
+#
+# the events for each sample in the hot loops are logged by `log.debug`,
+# gated by `log.isEnabledFor()` before the loop, so that nothing is
+# formatted unless verbose mode is on, and rate-limited for each message
+
+log = logging.getLogger('finsta360')
+
+
+class RateLimitFilter(logging.Filter):
+    # pass at most `rate` records per second for each message,
+    # and count the others which are dropped
+    def __init__(self, rate=20):
+        super().__init__()
+        self.rate = rate
+        self.counts = {}
+
+    def filter(self, record):
+        key = record.msg
+        second = int(record.created)
+        last, n, dropped = self.counts.get(key, (second, 0, 0))
+        if last != second:
+            if dropped > 0:
+                record.msg = f'{key} (+{dropped} dropped)'
+            n = 0
+            dropped = 0
+        if n >= self.rate:
+            self.counts[key] = (second, n, dropped + 1)
+            return False
+        self.counts[key] = (second, n + 1, dropped)
+        return True
+
+
+class StdoutHandler(logging.StreamHandler):
+    # to sys.stdout at the time of each record,
+    # so that the records follow contextlib.redirect_stdout as print() does
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, stream):
+        pass
+
+
+def setup_logging(verbose=False, rate=20):
+    # replaces the handler of the previous call
+    handler = StdoutHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.addFilter(RateLimitFilter(rate))
+    log.handlers = [handler]
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    log.propagate = False
 
 
 # ## parsing mp4
@@ -265,13 +337,11 @@ def parse_uuid(buf):
 
 def print_binaries(buf, cur=None):
     if cur is None: cur = 0
+    lines = []
     for i in range(0, len(buf), 8):
-        print('%010X : ' % (i+cur), end='')
-        j = min(i+8, len(buf))
-        buf_ = buf[i:j]
-        print(' '.join(['%02X'%(b) for b in buf_]), end='')
-        print(' : ', end='')
-        print(''.join(['%c'%(b) for b in buf_]))        
+        buf_ = bytes(buf[i:i+8])
+        lines.append(f'{i+cur:010X} : {buf_.hex(" ").upper()} : {buf_.decode("latin-1")}')
+    print('\n'.join(lines))
 
 
 def print_atom_headers(f, verbose=False, pre_label=''):
@@ -411,11 +481,8 @@ def extract_moov(src_filename, dst_filename, n_chunk=65536, verbose=False):
         if f_src.tell() != moov_start: raise ValueError(f'seek failed? {f_src.tell()} != {moov_start}')
 
         if verbose:
-            it_moov = tqdm(range(moov_start, src_end, n_chunk))
-        else:
-            it_moov = range(moov_start, src_end, n_chunk)
-        #for src_cur in tqdm(range(moov_start, src_end, n_chunk)):
-        for src_cur in it_moov:
+            log.debug('moov at %d : %d bytes', moov_start, src_end - moov_start)
+        for src_cur in range(moov_start, src_end, n_chunk):
             f_dst.write(f_src.read(n_chunk))
         if src_end - src_cur > 0:
             f_dst.write(f_src.read(src_end - src_cur))
@@ -423,841 +490,2549 @@ def extract_moov(src_filename, dst_filename, n_chunk=65536, verbose=False):
 
 # ## regenerating sample tables from `mdat`
 
-def is_aac_header(buf, frame_length):
-    cpe = (buf[0] & 0b11100000) >> 5
-    element_instance_tag = (buf[0] & 0b00011110) >> 1
-    common_window = (buf[0] & 0b00000001)
-
-    if cpe != 0b001 or element_instance_tag != 0b0000:
-        # not stereo
-
-        # print('not stereo')
-        return False
-    elif common_window == 1:
-        window_sequence = (buf[1] & 0b01100000) >> 5
-
-        if window_sequence != 0b10:
-            # common case
-            always_0 = (buf[1] & 0b10000000) >> 7
-            maxsfb = ((buf[1] & 0b00001111) << 2) | ((buf[2] & 0b11000000) >> 6)
-            predictor = (buf[2] & 0b00100000) >> 5
-            gain = ((buf[2] & 0b00000111) << 5) | ((buf[3] & 0b11111000) >> 3)
-            inc = (buf[4] & 0b01111100) >> 2
-
-            if always_0 == 0 and 40 <= maxsfb and maxsfb <= 51 and predictor == 0 and 100 <= gain and gain <= 228 and inc != 0:
-                print('common case')
-                return True
+# the rules to detect the head of raw AAC frame (stereo, CPE)
+# are decoded into lookup tables of one or two bytes, so that each
+# candidate costs a few table lookups instead of the bit arithmetic
+
+AAC_CASES = (
+    None,
+    'common case',
+    'eight-short-sequence',
+    'multiple windows',
+    'multiple windows and eight-short-sequence',
+    'degenerated block',
+    'degenerated block with padding',
+)
+
+_aac_tables = None
+
+
+def build_aac_tables():
+    # common_window == 1 (buf[0] == 0x21)
+    #   buf[1], buf[2] -> 1: common case, 2: eight-short-sequence
+    cw_12 = bytearray(65536)
+    #   buf[2], buf[3] -> global_gain of common case
+    cw_gain = bytearray(65536)
+    #   buf[4] -> inc of common case
+    cw_inc = bytearray(256)
+    #   buf[3], buf[4] -> global_gain of eight-short-sequence
+    cw_short_gain = bytearray(65536)
+
+    # common_window == 0 (buf[0] == 0x20)
+    #   buf[2], buf[3] -> 3..6 in AAC_CASES
+    ind_23 = bytearray(65536)
+    #   buf[1] -> global_gain
+    ind_gain = bytearray(256)
+
+    for b in range(256):
+        cw_inc[b] = ((b & 0b01111100) >> 2) != 0
+        ind_gain[b] = 100 <= b and b <= 200
+
+    for b1 in range(256):
+        for b2 in range(256):
+            i = (b1 << 8) | b2
+
+            window_sequence = (b1 & 0b01100000) >> 5
+            if window_sequence != 0b10:
+                always_0 = (b1 & 0b10000000) >> 7
+                maxsfb = ((b1 & 0b00001111) << 2) | ((b2 & 0b11000000) >> 6)
+                predictor = (b2 & 0b00100000) >> 5
+                if always_0 == 0 and 40 <= maxsfb and maxsfb <= 51 and predictor == 0:
+                    cw_12[i] = 1
             else:
-                # print('not common case')
-                return False
-        else:
-            # eight-short-sequence
-            always_10 = (buf[1] & 0b01100000) >> 5
-            maxsfb = (buf[1] & 0b00001111)
-            gain = ((buf[3] & 0b01111111) << 1) | ((buf[4] & 0b10000000) >> 7)
-
-            if always_10 == 0b10 and maxsfb >= 8 and 100 <= gain and gain <= 200:
-                print('eight-short-sequence')
-                return True
+                maxsfb = (b1 & 0b00001111)
+                if maxsfb >= 8:
+                    cw_12[i] = 2
+
+            # (b1, b2) as (buf[2], buf[3])
+            gain = ((b1 & 0b00000111) << 5) | ((b2 & 0b11111000) >> 3)
+            cw_gain[i] = 100 <= gain and gain <= 228
+
+            # (b1, b2) as (buf[3], buf[4])
+            gain = ((b1 & 0b01111111) << 1) | ((b2 & 0b10000000) >> 7)
+            cw_short_gain[i] = 100 <= gain and gain <= 200
+
+            # (b1, b2) as (buf[2], buf[3])
+            pulse_data = (b2 & 0b00001000) >> 3
+            tns_data = (b2 & 0b00000100) >> 2
+            gain_control_data = (b2 & 0b00000010) >> 1
+            if pulse_data != 0 or tns_data != 0 or gain_control_data != 0:
+                maxsfb = ((b1 & 0b00001111) << 2) | ((b2 & 0b11000000) >> 6)
+                if maxsfb != 0:
+                    always_0 = (b1 & 0b10000000) >> 7
+                    window_sequence = (b1 & 0b01100000) >> 5
+                    if always_0 != 0:
+                        pass
+                    elif window_sequence != 0b10:
+                        if 48 <= maxsfb and maxsfb <= 51:
+                            ind_23[i] = 3
+                    elif (b1 & 0b00001111) >= 8:
+                        ind_23[i] = 4
+                else:
+                    ind_23[i] = 5
             else:
-                # print('not eight-short-sequence')
-                return False
+                maxsfb = ((b1 & 0b00000111) << 3) | ((b2 & 0b11100000) >> 5)
+                if maxsfb == 0:
+                    ind_23[i] = 6
+
+    return (bytes(cw_12), bytes(cw_gain), bytes(cw_inc), bytes(cw_short_gain),
+            bytes(ind_23), bytes(ind_gain))
+
+
+def aac_tables():
+    global _aac_tables
+    if _aac_tables is None:
+        _aac_tables = build_aac_tables()
+    return _aac_tables
+
+
+def aac_header_case(buf, frame_length, tables=None):
+    # returns the index of AAC_CASES, or 0 if buf is not the head of AAC frame
+    if tables is None: tables = aac_tables()
+    cw_12, cw_gain, cw_inc, cw_short_gain, ind_23, ind_gain = tables
+
+    # cpe == 0b001 and element_instance_tag == 0b0000
+    if buf[0] == 0x21:
+        case = cw_12[(buf[1] << 8) | buf[2]]
+        if case == 1:
+            if cw_gain[(buf[2] << 8) | buf[3]] and cw_inc[buf[4]]: return 1
+        elif case == 2:
+            if cw_short_gain[(buf[3] << 8) | buf[4]]: return 2
+        return 0
+    elif buf[0] == 0x20:
+        case = ind_23[(buf[2] << 8) | buf[3]]
+        if case == 3 or case == 4:
+            if ind_gain[buf[1]]: return case
+        elif case == 5:
+            # degenerated block
+            if frame_length == 7: return 5
+        elif case == 6:
+            # degenerated block with padding
+            if (buf[5] & 0b00011111) == 0: return 6
+        return 0
     else:
-        pulse_data = (buf[3] & 0b00001000) >> 3
-        tns_data = (buf[3] & 0b00000100) >> 2
-        gain_control_data = (buf[3] & 0b00000010) >> 1
+        # not stereo
+        return 0
 
-        if pulse_data != 0 or tns_data != 0 or gain_control_data != 0:
-            maxsfb = ((buf[2] & 0b00001111) << 2) | ((buf[3] & 0b11000000) >> 6)
 
-            if maxsfb != 0:
-                gain = buf[1]
-                always_0 = (buf[2] & 0b10000000) >> 7
+def is_aac_header(buf, frame_length):
+    return aac_header_case(buf, frame_length) != 0
+
+
+# candidates of the head of AAC frame, CPE with element_instance_tag 0
+AAC_CANDIDATE = re.compile(b'[\x20\x21]')
+
+
+def split_aac_frames(mm, start, end, min_length=6):
+    # split an audio run [start, end) into raw AAC frames
+    tables = aac_tables()
+    frames = []
+    frame_start = start
+    for m in AAC_CANDIDATE.finditer(mm, start + min_length, end):
+        offset = m.start()
+        frame_length = offset - frame_start
+        if frame_length < min_length: continue
+        buf = mm[offset:offset+6]
+        if len(buf) < 6: break
+        if aac_header_case(buf, frame_length, tables) != 0:
+            frames.append((frame_start, frame_length))
+            frame_start = offset
+    frames.append((frame_start, end - frame_start))
+    return frames
+
+
+# each signature is (value, mask, length) of the head bytes of a sample,
+# and it matches when (head & mask) == value
+
+# access unit delimiter at the head of each video sample
+# H.264
+#   00 00 00 02 : NAL length
+#   09 F0       : AUD (nal_unit_type = 9, primary_pic_type = 7)
+# H.265
+#   00 00 00 03 : NAL length
+#   46 01       : AUD (nal_unit_type = 35, nuh_layer_id = 0, nuh_temporal_id_plus1 = 1)
+#   xx          : pic_type and rbsp_stop_one_bit
+VIDEO_SIGNATURES = {
+    'avc1': (0x0000000209F0, 0xFFFFFFFFFFFF, 6),
+    'avc3': (0x0000000209F0, 0xFFFFFFFFFFFF, 6),
+    'hvc1': (0x000000034601, 0xFFFFFFFFFFFF, 6),
+    'hev1': (0x000000034601, 0xFFFFFFFFFFFF, 6),
+}
+VIDEO_SIGNATURE = VIDEO_SIGNATURES['avc1']
+
+# raw AAC frame starts with CPE (0b001) of element_instance_tag 0
+AUDIO_SIGNATURE = (0x20, 0xFE, 1)
+
+# the other tracks are classified only by their learned signatures,
+# which must be strong enough not to be found in the audio
+MIN_META_SIGNATURE_BITS = 24
+
+# the learned signatures of video and audio must be as strong as these
+MIN_VIDEO_SIGNATURE_BITS = 24
+MIN_AUDIO_SIGNATURE_BITS = 7
+
+# upper limits of a video sample and of an audio run in the salvage mode,
+# beyond which the region is regarded as damaged
+MAX_FRAME_SIZE = 8 << 20
+MAX_AUDIO_RUN = 256 << 10
+
+
+def match_signature(buf, signature):
+    value, mask, length = signature
+    if len(buf) < length: return False
+    return (int.from_bytes(buf[:length], 'big') & mask) == value
+
+
+def is_hevc(codec):
+    return codec in ('hvc1', 'hev1')
+
+
+def is_nal_header(buf, codec):
+    # buf is the first 2 bytes of a NAL unit
+    if is_hevc(codec):
+        # forbidden_zero_bit (1), nal_unit_type (6), nuh_layer_id (6), nuh_temporal_id_plus1 (3)
+        return (buf[0] & 0x80) == 0 and (buf[1] & 0x07) != 0
+    else:
+        # forbidden_zero_bit (1), nal_ref_idc (2), nal_unit_type (5)
+        return (buf[0] & 0x80) == 0 and (buf[0] & 0x1F) != 0
 
-                if 100 <= gain and gain <= 200 and always_0 == 0:
-                    window_sequence = (buf[2] & 0b01100000) >> 5
 
-                    if window_sequence != 0b10:
-                        # multiple windows
+def is_sync_nal(buf, codec):
+    # IDR picture (H.264), or IRAP picture (H.265)
+    if is_hevc(codec):
+        nal_unit_type = (buf[0] & 0b01111110) >> 1
+        return 16 <= nal_unit_type and nal_unit_type <= 23
+    else:
+        return (buf[0] & 0x1F) == 5
 
-                        if 48 <= maxsfb and maxsfb <= 51:
-                            print('multiple windows')
-                            return True
-                        else:
-                            # print('not multiple windows')
-                            return False
-                    else:
-                        # multiple windows and eight-short-sequence
-                        maxsfb = (buf[2] & 0b00001111)
 
-                        if maxsfb >= 8:
-                            print('multiple windows and eight-short-sequence')
-                            return True
-                        else:
-                            # print('not multiple windows and eight-short-sequence')
-                            return False
-                else:
-                    # print('not multiple windows type')
-                    return False
+def read_video_codec(filename):
+    # sample description format of the first video track ('avc1', 'hvc1', ...)
+    with open(filename, 'rb') as f_in:
+        f_in.seek(0, 2)
+        file_size = f_in.tell()
+        for track in read_sample_tables(f_in, file_size):
+            if track['handler'] != 'vide' or track['stsd'] is None: continue
+            return str(track['stsd'][12:16], 'latin-1')
+    return None
+
+
+def has_audio_track(filename):
+    # whether the file declares a sound track
+    with open(filename, 'rb') as f_in:
+        f_in.seek(0, 2)
+        file_size = f_in.tell()
+        return any(track['handler'] == 'soun' for track in read_sample_tables(f_in, file_size))
+
+
+def default_scan_rules(codec='avc1'):
+    if not codec in VIDEO_SIGNATURES: raise ValueError(f'unsupported video codec: {codec}')
+    return {
+        'codec': codec,
+        'video': VIDEO_SIGNATURES[codec],
+        'audio': AUDIO_SIGNATURE,
+        'meta': [],
+        'max_frame_size': MAX_FRAME_SIZE,
+        'max_audio_run': MAX_AUDIO_RUN,
+    }
+
+
+def signature_from_profile(track):
+    value = bytes.fromhex(track['signature'])
+    mask = bytes.fromhex(track['mask'])
+    return (int.from_bytes(value, 'big'), int.from_bytes(mask, 'big'), len(value))
+
+
+def is_plausible_signature(handler, signature):
+    # the learned signature of video or audio is used only if it is strong enough,
+    # and constrains only the bits which are the same in any stream,
+    # that is, the first NAL unit (AUD) of video samples
+    # and the first syntax element of AAC frames
+    value, mask, length = signature
+    if handler == 'vide':
+        if bin(mask).count('1') < MIN_VIDEO_SIGNATURE_BITS: return False
+        # the length of the first NAL unit must be constrained
+        if length < 4 or mask >> (8*(length - 4)) != 0xFFFFFFFF: return False
+        return length <= 4 + (value >> (8*(length - 4)))
+    else:
+        if bin(mask).count('1') < MIN_AUDIO_SIGNATURE_BITS: return False
+        return length <= AUDIO_SIGNATURE[2]
+
+
+def load_scan_rules(profile_filename, codec=None):
+    # profile is made by learn.py from a healthy reference file
+    with open(profile_filename, 'r') as f:
+        profile = json.load(f)
+
+    if codec is None:
+        codec = 'avc1'
+        for track in profile['tracks']:
+            if track['handler'] == 'vide' and track.get('codec') in VIDEO_SIGNATURES:
+                codec = track['codec']
+                break
+
+    rules = default_scan_rules(codec)
+    rules['profile'] = profile
+
+    # the first track of each handler type is used
+    for handler, key in (('vide', 'video'), ('soun', 'audio')):
+        for track in profile['tracks']:
+            if track['handler'] != handler: continue
+            if handler == 'vide':
+                # the reference may have no scene as complex as the source,
+                # so the learned bound only raises the default
+                rules['max_frame_size'] = max(MAX_FRAME_SIZE, 4 * track['size_max'])
+            if len(track['signature']) == 0: break
+            signature = signature_from_profile(track)
+            if is_plausible_signature(handler, signature):
+                rules[key] = signature
             else:
-                # degenerated block
+                print(f'WARNING: the learned {handler} signature {track["signature"]} / {track["mask"]}'
+                      f' is not used')
+            break
 
-                if frame_length == 7:
-                    print('degenerated block')
-                    return True
+    if 'interleave' in profile:
+        interleave = profile['interleave']
+        longest = max([interleave['audio_bytes_per_run']] + interleave['audio_run_bytes'])
+        rules['max_audio_run'] = int(8 * longest)
+
+    # the other tracks (gyro, metadata, ...) written by the camera
+    # (handler, signature, sample size or 0 if variable)
+    for track in profile['tracks']:
+        if track['handler'] in ('vide', 'soun'): continue
+        if track['handler'] in [handler for handler, _, _ in rules['meta']]: continue
+        signature = signature_from_profile(track)
+        if bin(signature[1]).count('1') < MIN_META_SIGNATURE_BITS: continue
+        size = track['size_min'] if track['size_min'] == track['size_max'] else 0
+        rules['meta'].append((track['handler'], signature, size))
+
+    return rules
+
+
+def signature_prefix(signature):
+    # leading bytes without masked bits, to be searched in bulk
+    value, mask, length = signature
+    prefix = value.to_bytes(length, 'big')
+    mask = mask.to_bytes(length, 'big')
+    n = 0
+    while n < length and mask[n] == 0xFF:
+        n += 1
+    return prefix[:n]
+
+
+def find_signature(mm, signature, start, end):
+    # returns the first position of the signature in [start, end), or -1
+    prefix = signature_prefix(signature)
+    length = signature[2]
+    cur = start
+    while cur < end:
+        if len(prefix) > 0:
+            cur = mm.find(prefix, cur, end)
+            if cur < 0: return -1
+        if match_signature(mm[cur:cur+length], signature): return cur
+        cur += 1
+    return -1
+
+
+# zero-filled or never written (sparse) regions of a broken recording
+# no sample contains a zero run this long, since H.264/H.265 NAL units
+# never contain 00 00 00 (emulation prevention)
+MIN_ZERO_RUN = 4096
+ZERO_PROBE = bytes(64)
+ZERO_BLOCK_SIZE = 1 << 16
+ZERO_BLOCK = bytes(ZERO_BLOCK_SIZE)
+
+# the zero runs are probed in this window ahead of the scan,
+# so that the scan does not read the source beyond what it needs
+# (a scan stopped early reads at most this much ahead; a smaller window
+# costs more probes, but 256 KiB is as fast as 1 MiB for a full scan)
+ZERO_PROBE_WINDOW = 256 << 10
+
+
+def zero_run_end(mm, fd, start, end):
+    # returns the end of the zero bytes from start
+    # the holes of a sparse file are jumped over by SEEK_DATA,
+    # and the written blocks are compared with the zero block
+    cur = start
+    while cur < end:
+        if hasattr(os, 'SEEK_DATA'):
+            try:
+                data = os.lseek(fd, cur, os.SEEK_DATA)
+            except OSError:
+                # a hole until the end of file
+                return end
+            if data > cur:
+                cur = min(data, end)
+                continue
+        block = mm[cur:min(cur+ZERO_BLOCK_SIZE, end)]
+        if len(block) == ZERO_BLOCK_SIZE and block == ZERO_BLOCK:
+            cur += ZERO_BLOCK_SIZE
+            continue
+        n = len(block) - len(block.lstrip(b'\x00'))
+        cur += n
+        if n < len(block): break
+    return min(cur, end)
+
+
+def find_zero_run(mm, fd, start, end, min_length=MIN_ZERO_RUN, probe_end=None):
+    # returns (run_start, run_end) of the first zero run starting in [start, probe_end)
+    # which is longer than min_length or reaches the end,
+    # or (probe_end, probe_end) if it is not found (probe_end is end by default)
+    if probe_end is None: probe_end = end
+    probe_end = min(probe_end, end)
+    cur = start
+    while cur < probe_end:
+        run_start = mm.find(ZERO_PROBE, cur, min(probe_end + len(ZERO_PROBE) - 1, end))
+        if run_start < 0: break
+        run_end = zero_run_end(mm, fd, run_start, end)
+        if run_end - run_start >= min_length or run_end >= end:
+            return run_start, run_end
+        cur = run_end
+    return max(cur, probe_end), max(cur, probe_end)
+
+
+def probe_zero_run(mm, fd, zero_run, until, end):
+    # zero_run is (run_start, run_end) from find_zero_run() in a window,
+    # which is probed further window by window while no run is found, up to until
+    run_start, run_end = zero_run
+    while run_start == run_end < min(until, end):
+        run_start, run_end = find_zero_run(
+            mm, fd, run_start, end, probe_end=min(run_start + ZERO_PROBE_WINDOW, until))
+    return run_start, run_end
+
+
+# the source is copied to the output in blocks of this size during the scan
+COPY_BLOCK_SIZE = 8 << 20
+
+
+def copy_range(mm, f_dst, start, end):
+    # without copying into a bytes object
+    with memoryview(mm)[start:end] as view:
+        f_dst.write(view)
+
+
+# the trailer of insv, after the media data, ends with
+#   (records) (38 bytes) (trailer length, version as <II) (magic)
+# and each record is followed by its (id, size) as <HI,
+# so that the records are found from the end
+TRAILER_MAGIC = b'8db42d694ccc418790edff439fe026bf'
+TRAILER_PROBE = 4096
+TRAILER_FOOTER = 78
+
+def find_trailer(f_in, file_size):
+    # returns (start of the trailer, [(id, offset, size)] of the records),
+    # or None without the trailer
+    # only the tail of the file is read
+    probe = min(TRAILER_PROBE, file_size)
+    f_in.seek(file_size - probe)
+    buf = f_in.read(probe)
+    if not buf.endswith(TRAILER_MAGIC): return None
+    length, _ = struct.unpack('<II', buf[-40:-32])
+    if length < TRAILER_FOOTER or length > file_size: return None
+    start = file_size - length
+
+    records = []
+    cur = file_size - TRAILER_FOOTER
+    while cur - 6 > start:
+        if cur - 6 >= file_size - probe:
+            record_id, size = struct.unpack('<HI', buf[cur - 6 - file_size:cur - file_size])
+        else:
+            f_in.seek(cur - 6)
+            record_id, size = struct.unpack('<HI', f_in.read(6))
+        if cur - 6 - size < start: break
+        records.append((record_id, cur - 6 - size, size))
+        cur -= 6 + size
+    records.reverse()
+    return start, records
+
+
+def find_mdat(f_in):
+    # returns the range of the payload of 'mdat'
+    f_in.seek(0, 2)
+    file_size = f_in.tell()
+
+    # look for 'mdat'
+    src_cur = 0
+    while True:
+        f_in.seek(src_cur)
+        if f_in.tell() != src_cur: raise ValueError(f'seek failed? {f_in.tell()} != {src_cur}')
+
+        n, atom_type = read_atom_head(f_in)
+        if atom_type == 'mdat': break
+        if n == 0: raise ValueError('mdat not found')
+        src_cur += n
+        if src_cur >= file_size: raise ValueError('mdat not found')
+
+    # 'mdat' is found
+    # 8 bytes for the header (PLUS 8 bytes for the 64-bit size)
+    data_start = f_in.tell()
+    if n == 0:
+        # mdat from impcomplete mp4 file
+        mdat_end = file_size
+        f_in.seek(src_cur)
+        head = struct.unpack('>I', f_in.read(4))[0]
+        if head == 1:
+            data_start = src_cur + 16
+        else:
+            data_start = src_cur + 8
+    else:
+        mdat_end = min(src_cur + n, file_size)
+
+    # the scan stops at the trailer of insv
+    trailer = find_trailer(f_in, file_size)
+    if trailer is not None and data_start <= trailer[0] < mdat_end:
+        log.debug('trailer at %d : %d records', trailer[0], len(trailer[1]))
+        mdat_end = trailer[0]
+
+    return data_start, mdat_end
+
+
+# the end of an audio run is searched up to this many bytes after the expected end
+PREDICT_WINDOW = 256
+
+
+def expected_audio_run(run_counts, rules):
+    # the mean length of the audio runs of the reference if learned,
+    # or of those observed, or None before any run
+    profile = rules.get('profile')
+    if profile is not None and 'interleave' in profile:
+        return int(profile['interleave']['audio_bytes_per_run'])
+    if len(run_counts) == 0: return None
+    return sum(run * count for run, count in run_counts.items()) // sum(run_counts.values())
+
+
+def walk_video_sample(mm, cur, end, codec, audio_signature, stop_signatures, n_head, max_frame_size=None):
+    # walk through the NAL units from the AUD at cur until the next sample
+    # returns (frame_length, sync, valid), where valid is False
+    # if a NAL length is implausible for max_frame_size
+    buf = mm[cur:cur+n_head]
+    frame_length = 0
+    sync = False
+    while True:
+        nal_length = struct.unpack('>I', buf[:4])[0]
+        frame_length += nal_length + 4
+        if max_frame_size is not None:
+            if nal_length == 0 or frame_length > max_frame_size:
+                return frame_length, sync, False
+        if cur+frame_length >= end: break
+        buf = mm[cur+frame_length:cur+frame_length+n_head]
+        if len(buf) < 6: break
+        if match_signature(buf, audio_signature): break
+        if any(match_signature(buf, signature) for signature in stop_signatures): break
+        if not is_nal_header(buf[4:6], codec): break
+        if is_sync_nal(buf[4:6], codec): sync = True
+    return frame_length, sync, True
+
+
+def find_video_sample(mm, start, end, rules, stop_signatures, n_head, sync=False):
+    # the next video sample whose NAL units are plausible, found by
+    # the bulk search of the video signature
+    # with sync=True, the next GOP start, that is, with a sync NAL unit
+    codec = rules['codec']
+    cur = start
+    while cur < end:
+        cur = find_signature(mm, rules['video'], cur, end)
+        if cur < 0: break
+        frame_length, is_sync, valid = walk_video_sample(
+            mm, cur, end, codec, rules['audio'], stop_signatures, n_head, rules['max_frame_size'])
+        if valid and (is_sync or not sync) and cur+frame_length <= end: return cur
+        cur += 1
+    return end
+
+
+def recover_sample_tables_from_mdat_fast(
+    filename,
+    rules=None,
+    predict=False,
+    split_aac=False,
+    salvage=False,
+    start=None,
+    end=None,
+    copy_to=None,
+    stop_after=None,
+    verbose=False):
+    # classify all streams in mdat in a single pass
+    # returns the sample tables, (offset, size) of each sample, by handler type
+    # and the sync samples (1-based) of the video
+    # with start and end, only the samples starting in [start, end) are scanned
+    # from the first video sample after start
+    # with copy_to, the whole file is copied to it as the scan proceeds,
+    # while the scanned blocks are still in the page cache
+    # with stop_after, the scan stops after this number of video samples
+    # the zero-filled regions, and in the salvage mode the damaged regions
+    # until the next GOP, are skipped and logged as (offset, size) in tables['skipped']
+    if rules is None: rules = default_scan_rules()
+    codec = rules['codec']
+    video_signature = rules['video']
+    audio_signature = rules['audio']
+    meta_rules = rules['meta']
+    n_head = max([6, video_signature[2], audio_signature[2]]
+                 + [signature[2] for _, signature, _ in meta_rules])
+    max_frame_size = rules['max_frame_size'] if salvage else None
+
+    # the signatures which end an audio run
+    stop_signatures = [video_signature] + [signature for _, signature, _ in meta_rules]
+
+    tables = {
+        'vide': [],
+        'soun': [],
+        'sync': [],
+        'skipped': [],
+    }
+    for handler, _, _ in meta_rules:
+        tables[handler] = []
+    mov_table = tables['vide']
+    aac_table = tables['soun']
+    skipped = tables['skipped']
+
+    # for the predictive scan
+    run_counts = {}
+    expected_run = expected_audio_run(run_counts, rules)
+    n_runs = 0
+    n_predicted = 0
+
+    # no record is formatted in the loop unless it is emitted
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    with open(filename, 'rb') as f_in:
+        data_start, mdat_end = find_mdat(f_in)
+
+        fd = f_in.fileno()
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+
+            cur = data_start
+            scan_end = mdat_end
+            # an audio run is searched to its end up to search_end,
+            # which is limited for the scan of a window
+            search_end = mdat_end
+            if end is not None:
+                scan_end = min(end, mdat_end)
+                search_end = min(scan_end + rules['max_audio_run'], mdat_end)
+            if start is not None and start > data_start:
+                cur = find_video_sample(mm, start, scan_end, rules, stop_signatures, n_head)
+
+            # the next zero-filled region, which is skipped in bulk
+            # (zero_start == zero_end if none is found in the window probed so far)
+            zero_start, zero_end = find_zero_run(
+                mm, fd, cur, mdat_end, probe_end=min(cur + ZERO_PROBE_WINDOW, scan_end))
+
+            copied = 0
+
+            n = 0
+            while cur < scan_end:
+                if copy_to is not None and cur - copied >= COPY_BLOCK_SIZE:
+                    copy_range(mm, copy_to, copied, cur)
+                    copied = cur
+
+                if cur >= zero_start:
+                    if zero_end > cur:
+                        if debug: log.debug('%d: [zero] %d, %d', n, cur, zero_end - cur)
+                        skipped.append((cur, zero_end - cur))
+                        cur = zero_end
+                    zero_start, zero_end = find_zero_run(
+                        mm, fd, cur, mdat_end, probe_end=min(cur + ZERO_PROBE_WINDOW, scan_end))
+                    continue
+
+                buf = mm[cur:cur+n_head]
+
+                if match_signature(buf, video_signature):
+                    # h264 / h265 chunk
+                    frame_length, sync, valid = walk_video_sample(
+                        mm, cur, mdat_end, codec, audio_signature, stop_signatures, n_head, max_frame_size)
+
+                    if not valid:
+                        # garbage NAL length, resync at the next GOP
+                        next_cur = find_video_sample(mm, cur+1, scan_end, rules, stop_signatures, n_head, sync=True)
+                        if debug: log.debug('%d: [skip] %d, %d', n, cur, next_cur - cur)
+                        skipped.append((cur, next_cur - cur))
+                        cur = next_cur
+                        continue
+
+                    zero_start, zero_end = probe_zero_run(mm, fd, (zero_start, zero_end), cur+frame_length, mdat_end)
+                    if cur+frame_length > zero_start:
+                        # the last sample is truncated
+                        if zero_start >= mdat_end: break
+                        # the sample is cut by the zero-filled region
+                        skipped.append((cur, zero_start - cur))
+                        cur = zero_start
+                        continue
+
+                    if debug: log.debug('%d: [mov] %d, %d', n, cur, frame_length)
+                    mov_table.append((cur, frame_length))
+                    if sync: tables['sync'].append(len(mov_table))
+                    cur += frame_length
+                    n += 1
+                    if stop_after is not None and len(mov_table) >= stop_after: break
+                    continue
+
+                handler = 'soun'
+                frame_length = 0
+                for meta_handler, signature, size in meta_rules:
+                    if match_signature(buf, signature):
+                        handler = meta_handler
+                        frame_length = size
+                        break
+
+                if frame_length > 0:
+                    # fixed size sample of the other track
+                    zero_start, zero_end = probe_zero_run(mm, fd, (zero_start, zero_end), cur+frame_length, mdat_end)
+                    if cur+frame_length > zero_start:
+                        if zero_start >= mdat_end: break
+                        skipped.append((cur, zero_start - cur))
+                        cur = zero_start
+                        continue
+                    tables[handler].append((cur, frame_length))
+                    cur += frame_length
+                    n += 1
+                    continue
+
+                # the samples in mdat are raw AAC frames without ADTS header,
+                # so the audio continues until the next sample of the other tracks
+                if predict and handler == 'soun':
+                    # the end of the run is searched first up to the window predicted
+                    # by the interleave, from the start of the run, since a run
+                    # may be shorter than any seen before
+                    if expected_run is not None:
+                        predicted_end = min(cur + expected_run + PREDICT_WINDOW, search_end)
+                        window_end = predicted_end
+                        for signature in stop_signatures:
+                            pos = find_signature(mm, signature, cur+1, window_end)
+                            if pos >= 0: window_end = pos
+                        if window_end < predicted_end:
+                            frame_length = window_end - cur
+                    if frame_length > 0:
+                        # the run does not cross a zero-filled region
+                        zero_start, zero_end = probe_zero_run(mm, fd, (zero_start, zero_end), cur+frame_length, mdat_end)
+                        if cur+frame_length > zero_start:
+                            frame_length = 0
+                        else:
+                            n_predicted += 1
+                if frame_length == 0:
+                    # the run ends at the zero-filled region at the latest
+                    # beyond the probed region, the signatures are searched first
+                    # and the zeros are probed only up to the one found
+                    search_start = cur+1
+                    while True:
+                        if zero_end > zero_start or zero_start >= search_end:
+                            limit = min(zero_start, search_end)
+                        else:
+                            limit = min(zero_start + ZERO_PROBE_WINDOW, search_end)
+                        next_cur = limit
+                        for signature in stop_signatures:
+                            pos = find_signature(mm, signature, search_start, next_cur)
+                            if pos >= 0: next_cur = pos
+                        zero_start, zero_end = probe_zero_run(mm, fd, (zero_start, zero_end), next_cur, mdat_end)
+                        next_cur = min(next_cur, zero_start)
+                        if next_cur < limit or zero_end > zero_start or limit >= search_end: break
+                        search_start = max(cur+1, limit - n_head)
+                    frame_length = next_cur - cur
+
+                if salvage and handler == 'soun':
+                    if (len(buf) < 6 or frame_length > rules['max_audio_run']
+                        or not is_aac_header(buf, frame_length)):
+                        # neither audio nor the other tracks, resync at the next GOP
+                        next_cur = find_video_sample(mm, cur+1, scan_end, rules, stop_signatures, n_head, sync=True)
+                        if debug: log.debug('%d: [skip] %d, %d', n, cur, next_cur - cur)
+                        skipped.append((cur, next_cur - cur))
+                        cur = next_cur
+                        continue
+
+                if handler != 'soun':
+                    tables[handler].append((cur, frame_length))
                 else:
-                    # print('not degenerated block')
-                    return False
+                    if predict:
+                        # the runs are counted apart from the frames split by -a
+                        run_counts[frame_length] = run_counts.get(frame_length, 0) + 1
+                        n_runs += 1
+                        if n_runs % 64 == 0:
+                            expected_run = expected_audio_run(run_counts, rules)
+
+                    if debug: log.debug('%d: [aac] %d, %d', n, cur, frame_length)
+                    if split_aac:
+                        aac_table += split_aac_frames(mm, cur, cur+frame_length)
+                    else:
+                        aac_table.append((cur, frame_length))
+
+                cur += frame_length
+                n += 1
+
+            if copy_to is not None:
+                copy_range(mm, copy_to, copied, len(mm))
+
+    if predict and verbose:
+        log.info('predicted boundaries : %d / %d audio runs', n_predicted, n_runs)
+
+    return tables
+
+
+# ## persisting the sample tables
+#
+# the recovered tables are saved in a compact binary file, so that moov can
+# be rebuilt with other constants without scanning mdat again
+#   magic       : 8 bytes
+#   header size : 4 bytes (big endian)
+#   header      : json (source file, codec, and name, type and length of tables)
+#   tables      : big-endian arrays, offsets (64-bit) and sizes (32-bit)
+#                 of (offset, size) tables ('pair'), or with 64-bit sizes
+#                 if any of them is not within 32 bits ('pair64', as the
+#                 skipped regions), and 32-bit values of the others ('list')
+
+TABLES_MAGIC = b'finstbl1'
+
+
+def save_sample_tables(filename, tables, src_filename, codec):
+    header = {
+        'source': os.path.basename(src_filename),
+        'source_size': os.path.getsize(src_filename),
+        'codec': codec,
+        'tables': [],
+    }
+    chunks = []
+    for name, table in tables.items():
+        if len(table) > 0 and isinstance(table[0], tuple):
+            sizes = [size for _, size in table]
+            kind = 'pair64' if max(sizes) > 0xFFFFFFFF else 'pair'
+            chunks.append(pack_table([offset for offset, _ in table], 'Q'))
+            chunks.append(pack_table(sizes, 'Q' if kind == 'pair64' else 'I'))
+            header['tables'].append((name, kind, len(table)))
         else:
-            # degenerated block with padding
-            # gain = ((buf[1] & 0b01111111) << 1) | ((buf[2] & 0b10000000) >> 7)
-            maxsfb = ((buf[2] & 0b00000111) << 3) | ((buf[3] & 0b11100000) >> 5)
-            maxsfb2 = (buf[5] & 0b00011111)
+            chunks.append(pack_table(table, 'I'))
+            header['tables'].append((name, 'list', len(table)))
+
+    buf = json.dumps(header).encode('utf-8')
+    with open(filename, 'wb') as f_out:
+        f_out.write(TABLES_MAGIC)
+        f_out.write(struct.pack('>I', len(buf)))
+        f_out.write(buf)
+        for chunk in chunks:
+            f_out.write(chunk)
 
-            if maxsfb == 0 and maxsfb2 == 0:
-                print('degenerated block with padding')
-                return True
-            else:
-                # print('not degenerated block with padding')
-                return False
 
+def unpack_table(buf, cur, n, typecode='I'):
+    table = array.array(typecode)
+    table.frombytes(buf[cur:cur+n*table.itemsize])
+    if sys.byteorder == 'little': table.byteswap()
+    return table.tolist(), cur + n*table.itemsize
 
-def recover_sample_tables_from_mdat_fast(filename, verbose=False):
-    mov_table = []
-    aac_table = []
 
+def load_sample_tables(filename):
+    # returns (tables, header)
     with open(filename, 'rb') as f_in:
+        buf = f_in.read()
+    if buf[:8] != TABLES_MAGIC: raise ValueError(f'{filename} is not a sample table file')
+    n = struct.unpack('>I', buf[8:12])[0]
+    header = json.loads(buf[12:12+n].decode('utf-8'))
+
+    tables = {}
+    cur = 12 + n
+    for name, kind, n_entries in header['tables']:
+        if kind in ('pair', 'pair64'):
+            offsets, cur = unpack_table(buf, cur, n_entries, 'Q')
+            sizes, cur = unpack_table(buf, cur, n_entries, 'Q' if kind == 'pair64' else 'I')
+            tables[name] = list(zip(offsets, sizes))
+        else:
+            tables[name], cur = unpack_table(buf, cur, n_entries, 'I')
+    return tables, header
 
-        # look for 'mdat'
-        src_cur = 0
-        while True:
-            f_in.seek(src_cur)
-            if f_in.tell() != src_cur: raise ValueError(f'seek failed? {f_in.tell()} != {src_cur}')
 
-            n, atom_type = read_atom_head(f_in)
-            if atom_type == 'mdat': break
-            src_cur += n
+# ## rebuilding `moov` from sample tables
 
-        # 'mdat' is found
-        mdat_start = src_cur
-        if n == 0:
-            # mdat from impcomplete mp4 file
-            f_in.seek(0, 2)
-            mdat_end = f_in.tell()
-            # seek the data_start position
-            # 8 bytes for the header PLUS 8 bytes for the reserved space of the size
-            # f_in.seek(src_cur + 16)
-            f_in.seek(src_cur)
-            buf = f_in.read(4)
-            head = struct.unpack('>I', buf)[0]
-            if head == 1:
-                f_in.seek(src_cur + 16)
-            else:
-                f_in.seek(src_cur + 8)
-        else:
-            mdat_end   = src_cur + n
-
-        # n = 0
-        # while True:
-        #     cur = f_in.tell()
-        #     if cur >= mdat_end: break
-
-        #     # buf = f_in.read(4)
-        #     buf = f_in.read(6)
-
-        #     # if buf[0] != 0xFF or buf[1] != 0xF1 or buf[2] != 0x4C or (buf[3] & 0b11111100) != 0x80:
-        #     # if buf[0] != 0x21 or (buf[1] & 0b11101111) != 0x0A or (buf[2] & 0b11111110) != 0x14:
-        #     if buf[0] != 0x21:
-        #         # h264 chunk
-        #         frame_length = struct.unpack('>I', buf)[0] + 4
-        #         if cur+frame_length >= mdat_end: break
-
-        #         if verbose: print(f'{n}: [mov] {cur}, {frame_length}')
-        #         mov_table.append((cur, frame_length))
-        #         f_in.seek(cur+frame_length)
-        #     else:
-        #         # buf_2 = f_in.read(2)
-
-        #         # from https://wiki.multimedia.cx/index.php/ADTS
-        #         # AAAAAAAA AAAABCCD EEFFFFGH HHIJKLMM MMMMMMMM MMMOOOOO OOOOOOPP (QQQQQQQQ QQQQQQQQ)
-        #         # 0th-byte 1st      2nd      3rd      4th      5th      6th      (7th      8th     )
-        #         # 0xFF     0xF1     0x4C     0X80 -- typical case for Insta360 ONE-X
-        #         # M 13 frame length, this value must include 7 or 9 bytes of header length
-        #         #   FrameLength = (ProtectionAbsent == 1 ? 7 : 9) + size(AACFrame)
-        #         # frame_length = ((buf[3] & 0b11) << 11) | (buf_2[0] << 3) | (buf_2[1] >> 5)
-        #         # if cur+frame_length >= mdat_end: break
-
-        #         frame_length = 0
-        #         while True:
-        #             if cur + frame_length >= mdat_end:
-        #                 break
-
-        #             frame_length_2 = struct.unpack('>I', buf)[0] + 4
-        #             if frame_length_2 < 1048576 and cur + frame_length + frame_length_2 <= mdat_end:
-        #                 f_in.seek(cur + frame_length + frame_length_2)
-        #                 buf_2 = f_in.read(3)
-        #                 if buf_2[0] == 0x21:# and (buf_2[1] & 0b11101111) == 0x0A and (buf_2[2] & 0b11111110) == 0x14:
-        #                     # frame_length -= 6
-        #                     break
-
-        #             # flag = (buf[0] == 0x21)# and (buf[1] & 0b11101111) == 0x0A and (buf[2] & 0b11111110) == 0x14)
-        #             # if frame_length > 0 and flag:
-        #             #     break
-
-        #             frame_length += 1
-        #             f_in.seek(cur + frame_length)
-        #             buf = f_in.read(4)
-
-        #         if verbose: print(f'{n}: [aac] {cur}, {frame_length}')
-        #         aac_table.append((cur, frame_length))
-        #         f_in.seek(cur+frame_length)
-
-        #     n += 1
-        #     # frame_length = struct.unpack('>I', buf)[0] + 4
-        #     # if cur + frame_length > mdat_end:
-        #     #     break
-        #     # f_in.seek(cur + frame_length)
-        #     # buf_2 = f_in.read(4)
-        #     # if buf_2[0] == 0x21:
-        #     #     if verbose:
-        #     #         print(f'{n}: [mov] {cur}, {frame_length}')
-        #     #     mov_table.append((cur, frame_length))
-        #     #     if verbose:
-        #     #         print(f'{n}: [aac] {cur}, {frame_length}')
-        #     #     aac_table.append((cur, frame_length_2))
-        #     #     n += 1
-        #     #     frame_length_2 = 0
-        #     # else:
-        #     #     while True:
-        #     #         cur += 1
-        #     #         if cur > mdat_end or
-        #     #         frame_length_2 += 1
-        #     #     frame_length_2 = struct.unpack('>I', buf_2)[0] + 4
-        #     #     if cur + frame_length + frame_length_2 > mdat_end:
-        #     #         break
-        #     #     f_in.seek(cur + frame_length + frame_length_2)
-        #     #     buf_3 = f_in.read(4)
-        #     #     if buf_3 = f_in.read(1)
-        #     #     frame_length_2 += 1
-        #     #     f_in.seek(cur + 1)
-
-        n = 0
-        while True:
-            cur = f_in.tell()
-            if cur >= mdat_end: break
-
-            # buf = f_in.read(4)
-            buf = f_in.read(6)
-
-            # if buf[0] != 0xFF or buf[1] != 0xF1 or buf[2] != 0x4C or (buf[3] & 0b11111100) != 0x80:
-            if struct.unpack('>I', buf[:4])[0] == 2 and buf[4] == 0x09 and buf[5] == 0xF0:
-                # h264 chunk
-                # frame_length = struct.unpack('>I', buf)[0] + 4
-                # if cur+frame_length >= mdat_end: break
-                frame_length = 6
-                while True:
-                    buf = f_in.read(4)
-                    if (buf[0] & 0b11111110) == 0x20: break
-                    frame_length += struct.unpack('>I', buf)[0] + 4
-                    if cur+frame_length >= mdat_end: break
-                    f_in.seek(cur + frame_length)
-
-                if verbose: print(f'{n}: [mov] {cur}, {frame_length}')
-                mov_table.append((cur, frame_length))
-                f_in.seek(cur+frame_length)
-            else:
-                # buf_2 = f_in.read(2)
+CONTAINER_ATOMS = ('moov', 'trak', 'edts', 'mdia', 'minf', 'dinf', 'stbl')
+
+# atoms in stbl which describe the samples of the reference, and are
+# dropped since they are not recovered from mdat
+DROPPED_ATOMS = ('ctts', 'cslg', 'sdtp', 'stps', 'stsh', 'subs', 'saiz', 'saio')
+
+
+def read_atom_list(buf, start, end):
+    # (atom_type, atom_start, data_start, atom_end) of each atom in buf[start:end]
+    atoms = []
+    cur = start
+    while cur + 8 <= end:
+        n = struct.unpack('>I', buf[cur:cur+4])[0]
+        atom_type = str(buf[cur+4:cur+8], 'latin-1')
+        data_start = cur + 8
+        if n == 1:
+            # decode 64-bit size
+            n = struct.unpack('>Q', buf[cur+8:cur+16])[0]
+            data_start = cur + 16
+        elif n == 0:
+            n = end - cur
+        if n < 8: raise ValueError(f'broken atom {atom_type} at {cur}')
+        atoms.append((atom_type, cur, data_start, cur + n))
+        cur += n
+    return atoms
 
-                # from https://wiki.multimedia.cx/index.php/ADTS
-                # AAAAAAAA AAAABCCD EEFFFFGH HHIJKLMM MMMMMMMM MMMOOOOO OOOOOOPP (QQQQQQQQ QQQQQQQQ)
-                # 0th-byte 1st      2nd      3rd      4th      5th      6th      (7th      8th     )
-                # 0xFF     0xF1     0x4C     0X80 -- typical case for Insta360 ONE-X
-                # M 13 frame length, this value must include 7 or 9 bytes of header length
-                #   FrameLength = (ProtectionAbsent == 1 ? 7 : 9) + size(AACFrame)
-                # frame_length = ((buf[3] & 0b11) << 11) | (buf_2[0] << 3) | (buf_2[1] >> 5)
-                # if cur+frame_length >= mdat_end: break
 
-                frame_length = 6
-                while True:
-                    buf = f_in.read(6)
-                    # if is_aac_header(buf, frame_length): break
-                    if struct.unpack('>I', buf[:4])[0] == 2 and buf[4] == 0x09 and buf[5] == 0xF0: break
-                    frame_length += 1
-                    if cur + frame_length >= mdat_end: break
-                    f_in.seek(cur + frame_length)
+def find_atom(buf, start, end, path):
+    # path is like ('mdia', 'hdlr')
+    for atom in read_atom_list(buf, start, end):
+        atom_type, atom_start, data_start, atom_end = atom
+        if atom_type != path[0]: continue
+        if len(path) == 1: return atom
+        return find_atom(buf, data_start, atom_end, path[1:])
+    return None
 
-                # if verbose: print(f'{n}: [aac] {cur}, {frame_length}')
-                aac_table.append((cur, frame_length))
-                f_in.seek(cur+frame_length)
 
-            n += 1
+def table_array(values, typecode='I'):
+    # big-endian array of 32-bit ('I') or 64-bit ('Q') integers
+    table = array.array(typecode, values)
+    if sys.byteorder == 'little': table.byteswap()
+    return table
 
-    return mov_table, aac_table
 
+def pack_table(values, typecode='I'):
+    return table_array(values, typecode).tobytes()
 
-# ## rebuilding `moov` from sample tables
 
-def copy_atom_box(target_type, target_size, f_src, f_dst, only_header=True):
-    src_size, atom_type = read_atom_head(f_src)
-    if atom_type != target_type: raise ValueError(f'{target_type} not found but {atom_type}')
+def plan_track(buf, trak, tables, moov_const):
+    # decide how the trak is rebuilt from the recovered table
+    _, _, data_start, atom_end = trak
+
+    hdlr = find_atom(buf, data_start, atom_end, ('mdia', 'hdlr'))
+    handler = str(buf[hdlr[2]+8:hdlr[2]+12], 'latin-1')
+    table = tables.get(handler, [])
+    if len(table) == 0:
+        return None
+
+    mdhd = find_atom(buf, data_start, atom_end, ('mdia', 'mdhd'))
+    if buf[mdhd[2]] == 1:
+        timescale = struct.unpack('>I', buf[mdhd[2]+20:mdhd[2]+24])[0]
+    else:
+        timescale = struct.unpack('>I', buf[mdhd[2]+12:mdhd[2]+16])[0]
+
+    if handler == 'vide':
+        sample_duration = moov_const[0]
+        timescale = moov_const[3]
+    elif handler == 'soun':
+        sample_duration = moov_const[1]
+        timescale = moov_const[4]
+    else:
+        # the same sample duration as the reference
+        stts = find_atom(buf, data_start, atom_end, ('mdia', 'minf', 'stbl', 'stts'))
+        sample_duration = struct.unpack('>I', buf[stts[2]+12:stts[2]+16])[0]
+
+    mvhd_timescale = moov_const[2]
+    mdhd_duration = len(table) * sample_duration
+    tkhd_duration = int(mdhd_duration * mvhd_timescale / timescale)
+
+    return {
+        'handler': handler,
+        'table': table,
+        'sync': tables.get('sync', []) if handler == 'vide' else None,
+        'sample_duration': sample_duration,
+        'timescale': timescale,
+        'mdhd_duration': mdhd_duration,
+        'tkhd_duration': tkhd_duration,
+    }
+
+
+def rebuild_leaf(atom_type, payload, track, moov_plan):
+    # returns (atom_type, payload) of the rebuilt atom, or None to drop it
+    # payload is a memoryview of the reference, returned as it is if unchanged
+    # the payload of the sample tables is a tuple of the head and the table,
+    # which is copied into the output without joining them
+    version = payload[0] if len(payload) > 0 else 0
+
+    if atom_type == 'mvhd':
+        payload = bytearray(payload)
+        if version == 1:
+            payload[20:24] = struct.pack('>I', moov_plan['mvhd_timescale'])
+            payload[24:32] = struct.pack('>Q', moov_plan['mvhd_duration'])
+        else:
+            payload[12:16] = struct.pack('>I', moov_plan['mvhd_timescale'])
+            payload[16:20] = struct.pack('>I', moov_plan['mvhd_duration'])
+        return atom_type, bytes(payload)
+
+    if track is None:
+        return atom_type, payload
 
-    if target_size is None: target_size = src_size
+    table = track['table']
 
-    f_dst.write(struct.pack('>I', target_size))
-    f_dst.write(target_type.encode('utf-8'))
+    if atom_type == 'tkhd':
+        payload = bytearray(payload)
+        if version == 1:
+            payload[28:36] = struct.pack('>Q', track['tkhd_duration'])
+        else:
+            payload[20:24] = struct.pack('>I', track['tkhd_duration'])
+        return atom_type, bytes(payload)
+    elif atom_type == 'elst':
+        # the media segments cover the whole track
+        payload = bytearray(payload)
+        n_entries = struct.unpack('>I', payload[4:8])[0]
+        for i in range(n_entries):
+            if version == 1:
+                i0 = 8 + i*20
+                media_time = struct.unpack('>q', payload[i0+8:i0+16])[0]
+                if media_time >= 0:
+                    payload[i0:i0+8] = struct.pack('>Q', track['tkhd_duration'])
+            else:
+                i0 = 8 + i*12
+                media_time = struct.unpack('>i', payload[i0+4:i0+8])[0]
+                if media_time >= 0:
+                    payload[i0:i0+4] = struct.pack('>I', track['tkhd_duration'])
+        return atom_type, bytes(payload)
+    elif atom_type == 'mdhd':
+        # the timescale of -m as well as stts and tkhd
+        payload = bytearray(payload)
+        if version == 1:
+            payload[20:24] = struct.pack('>I', track['timescale'])
+            payload[24:32] = struct.pack('>Q', track['mdhd_duration'])
+        else:
+            payload[12:16] = struct.pack('>I', track['timescale'])
+            payload[16:20] = struct.pack('>I', track['mdhd_duration'])
+        return atom_type, bytes(payload)
+    elif atom_type == 'stts':
+        # all samples have the same duration
+        return atom_type, bytes(payload[:4]) + struct.pack('>III', 1, len(table), track['sample_duration'])
+    elif atom_type == 'stss':
+        if track['sync'] is None: return None
+        sync = track['sync']
+        return atom_type, (bytes(payload[:4]) + struct.pack('>I', len(sync)), table_array(sync))
+    elif atom_type == 'stsc':
+        if moov_plan.get('drefs') is not None:
+            # the samples of each chapter refer to its own sample description
+            entries = []
+            chunk = 1
+            for i, count in enumerate(track['chapters']):
+                if count == 0: continue
+                entries.append(struct.pack('>III', chunk, 1, i + 1))
+                chunk += count
+            return atom_type, bytes(payload[:4]) + struct.pack('>I', len(entries)) + b''.join(entries)
+        # one sample in each chunk
+        return atom_type, bytes(payload[:4]) + struct.pack('>IIII', 1, 1, 1, 1)
+    elif atom_type == 'dref' and moov_plan.get('drefs') is not None:
+        # the media data are in the external files
+        entries = []
+        for url in moov_plan['drefs']:
+            location = url.encode('utf-8') + b'\x00'
+            entries.append(struct.pack('>I4sI', 12 + len(location), b'url ', 0) + location)
+        return atom_type, bytes(payload[:4]) + struct.pack('>I', len(entries)) + b''.join(entries)
+    elif atom_type == 'stsd' and moov_plan.get('drefs') is not None:
+        # a copy of the first sample entry for each data reference
+        # the entry has 6 reserved bytes and data_reference_index after the header
+        n = struct.unpack('>I', payload[8:12])[0]
+        entry = bytearray(payload[8:8+n])
+        entries = []
+        for i in range(len(moov_plan['drefs'])):
+            entry[14:16] = struct.pack('>H', i + 1)
+            entries.append(bytes(entry))
+        return atom_type, bytes(payload[:4]) + struct.pack('>I', len(entries)) + b''.join(entries)
+    elif atom_type == 'stsz':
+        sizes = table_array([s for o, s in table])
+        return atom_type, (bytes(payload[:4]) + struct.pack('>II', 0, len(sizes)), sizes)
+    elif atom_type in ('stco', 'co64'):
+        offsets = [o for o, s in table]
+        if max(offsets) > 0xFFFFFFFF:
+            return 'co64', (bytes(payload[:4]) + struct.pack('>I', len(offsets)), table_array(offsets, 'Q'))
+        else:
+            return 'stco', (bytes(payload[:4]) + struct.pack('>I', len(offsets)), table_array(offsets))
+    elif atom_type == 'sbgp':
+        # all samples belong to the group of the first entry
+        if version == 1:
+            head = bytes(payload[:12])
+            entries = payload[16:]
+        else:
+            head = bytes(payload[:8])
+            entries = payload[12:]
+        if len(entries) < 8: return atom_type, payload
+        group_index = struct.unpack('>I', entries[4:8])[0]
+        return atom_type, head + struct.pack('>III', 1, len(table), group_index)
+    elif atom_type in DROPPED_ATOMS:
+        return None
+    else:
+        return atom_type, payload
+
+
+class Box:
+    # a node of the atom tree loaded from the reference moov
+    # a leaf has the payload as a tuple of pieces (bytes-like objects),
+    # and a container has the list of children
+    def __init__(self, atom_type, payload=(), children=None, offset=None):
+        self.type = atom_type
+        self.children = children
+        self.offset = offset
+        self.size = 0
+        self.set_payload(payload)
+
+    @classmethod
+    def load(cls, buf, atom):
+        # the leaf payloads are the views of buf, not copied
+        atom_type, atom_start, data_start, atom_end = atom
+        if atom_type in CONTAINER_ATOMS:
+            children = [cls.load(buf, sub_atom) for sub_atom in read_atom_list(buf, data_start, atom_end)]
+            return cls(atom_type, children=children, offset=atom_start)
+        return cls(atom_type, memoryview(buf)[data_start:atom_end], offset=atom_start)
+
+    def set_payload(self, payload):
+        if not isinstance(payload, tuple):
+            payload = (payload,)
+        self.payload = tuple(memoryview(piece).cast('B') for piece in payload)
+
+    def update_size(self):
+        # in one bottom-up pass
+        if self.children is None:
+            self.size = 8 + sum(len(piece) for piece in self.payload)
+        else:
+            self.size = 8 + sum(child.update_size() for child in self.children)
+        return self.size
+
+    def iter_pieces(self):
+        if self.size > 0xFFFFFFFF: raise ValueError(f'{self.type} is too large: {self.size}')
+        yield struct.pack('>I', self.size) + self.type.encode('latin-1')
+        if self.children is None:
+            yield from self.payload
+        else:
+            for child in self.children:
+                yield from child.iter_pieces()
+
+
+def rebuild_box(box, track, moov_plan):
+    # replace the payloads of the leaves which change, and drop the others
+    # returns False if the box itself is dropped
+    if box.children is not None:
+        if box.type == 'trak':
+            track = moov_plan['tracks'].get(box.offset)
+            if track is None:
+                # no sample is recovered for this track
+                return False
+        box.children = [child for child in box.children if rebuild_box(child, track, moov_plan)]
+        return True
 
-    if not only_header:
-        f_dst.write(f_src.read(target_size-8))
+    leaf = rebuild_leaf(box.type, box.payload[0], track, moov_plan)
+    if leaf is None:
+        return False
+    box.type, payload = leaf
+    box.set_payload(payload)
+    return True
+
+
+def build_moov(moov_const, buf, tables, verbose=False, drefs=None, chapters=None):
+    # returns the Box of moov rebuilt from the reference moov in buf
+    # with drefs (urls of the external files), the samples are in those files,
+    # and chapters has the number of samples in each of them by handler type
+    moov = read_atom_list(buf, 0, len(buf))[0]
+    if moov[0] != 'moov': raise ValueError(f'moov not found but {moov[0]}')
+
+    # the tracks declared in the reference moov
+    moov_plan = {
+        'mvhd_timescale': moov_const[2],
+        'mvhd_duration': 0,
+        'tracks': {},
+        'drefs': drefs,
+    }
+    for atom in read_atom_list(buf, moov[2], moov[3]):
+        if atom[0] != 'trak': continue
+        track = plan_track(buf, atom, tables, moov_const)
+        if track is None:
+            print(f'track at 0x{atom[1]:X} is skipped (no sample is recovered)')
+            continue
+        if verbose:
+            print(f'track at 0x{atom[1]:X} : {track["handler"]} {len(track["table"])} samples')
+        if drefs is not None:
+            track['chapters'] = [counts.get(track['handler'], 0) for counts in chapters]
+        moov_plan['tracks'][atom[1]] = track
+        moov_plan['mvhd_duration'] = max(moov_plan['mvhd_duration'], track['tkhd_duration'])
 
-    return src_size
+    box = Box.load(buf, moov)
+    rebuild_box(box, None, moov_plan)
+    box.update_size()
+    return box
 
 
 def recover_moov_from_sample_tables(
     moov_const,
     ref_filename, dst_filename,
-    mov_table, aac_table,
+    tables,
     full_copy=True, n_chunk=65536,
     verbose=False,
     ):
 
-    # constants
-    # mov_sample_duration = 1001
-    # aac_sample_duration = 1024
+    with open(ref_filename, 'rb') as f_moov:
+        buf = f_moov.read()
+
+    box = build_moov(moov_const, buf, tables, verbose=verbose)
+
+    # the whole tree is written by the vectored write
+    pieces = list(box.iter_pieces())
+    if full_copy:
+        # and the rest of reference moov file
+        moov_end = read_atom_list(buf, 0, len(buf))[0][3]
+        pieces.append(memoryview(buf)[moov_end:])
+
+    with open(dst_filename, 'wb') as f_dst:
+        write_gather(f_dst, pieces)
+
+
+# ## extracting elementary streams
+
+START_CODE = bytes([0x00, 0x00, 0x00, 0x01])
+
+# sampling_frequency_index of AudioSpecificConfig
+AAC_SAMPLING_FREQUENCIES = (
+    96000, 88200, 64000, 48000, 44100, 32000, 24000,
+    22050, 16000, 12000, 11025, 8000, 7350)
+
+
+def read_descriptor_head(buf, cur):
+    # tag and the variable length size of MPEG-4 descriptor
+    tag = buf[cur]
+    cur += 1
+    n = 0
+    for i in range(4):
+        b = buf[cur]
+        cur += 1
+        n = (n << 7) | (b & 0x7F)
+        if (b & 0x80) == 0: break
+    return tag, n, cur
+
+
+def parse_esds(buf):
+    # returns AudioSpecificConfig in ES_Descriptor of esds payload
+    cur = 4 # version + flags
+    tag, n, cur = read_descriptor_head(buf, cur)
+    if tag != 0x03: return None
+    # ES_Descriptor
+    flags = buf[cur+2]
+    cur += 3
+    if flags & 0x80: cur += 2 # streamDependenceFlag
+    if flags & 0x40: cur += 1 + buf[cur] # URL_Flag
+    if flags & 0x20: cur += 2 # OCRstreamFlag
+
+    tag, n, cur = read_descriptor_head(buf, cur)
+    if tag != 0x04: return None
+    # DecoderConfigDescriptor
+    cur += 13
+    tag, n, cur = read_descriptor_head(buf, cur)
+    if tag != 0x05: return None
+    # DecoderSpecificInfo
+    return bytes(buf[cur:cur+n])
+
+
+def parse_avcc(buf):
+    # SPS and PPS in AVCDecoderConfigurationRecord
+    parameter_sets = []
+    n_sps = buf[5] & 0b00011111
+    cur = 6
+    for i in range(n_sps):
+        n = struct.unpack('>H', buf[cur:cur+2])[0]
+        parameter_sets.append(bytes(buf[cur+2:cur+2+n]))
+        cur += 2 + n
+    n_pps = buf[cur]
+    cur += 1
+    for i in range(n_pps):
+        n = struct.unpack('>H', buf[cur:cur+2])[0]
+        parameter_sets.append(bytes(buf[cur+2:cur+2+n]))
+        cur += 2 + n
+    return parameter_sets
+
+
+def parse_hvcc(buf):
+    # VPS, SPS, PPS, ... in HEVCDecoderConfigurationRecord
+    parameter_sets = []
+    n_arrays = buf[22]
+    cur = 23
+    for i in range(n_arrays):
+        n_nalus = struct.unpack('>H', buf[cur+1:cur+3])[0]
+        cur += 3
+        for j in range(n_nalus):
+            n = struct.unpack('>H', buf[cur:cur+2])[0]
+            parameter_sets.append(bytes(buf[cur+2:cur+2+n]))
+            cur += 2 + n
+    return parameter_sets
+
+
+def read_decoder_configs(moov_filename):
+    # decoder configurations in stsd of the first track of each handler type
+    configs = {}
+    with open(moov_filename, 'rb') as f_in:
+        f_in.seek(0, 2)
+        file_size = f_in.tell()
+        tracks = read_sample_tables(f_in, file_size)
+
+    for track in tracks:
+        handler = track['handler']
+        stsd = track['stsd']
+        if stsd is None or handler in configs: continue
+
+        entry_size = struct.unpack('>I', stsd[8:12])[0]
+        entry = stsd[8:8+entry_size]
+        data_format = str(entry[4:8], 'latin-1')
+
+        if handler == 'vide':
+            # 78 bytes of VisualSampleEntry are followed by the atoms
+            for atom_type, _, data_start, atom_end in read_atom_list(entry, 8 + 78, len(entry)):
+                if atom_type == 'avcC':
+                    configs['vide'] = (data_format, parse_avcc(entry[data_start:atom_end]))
+                elif atom_type == 'hvcC':
+                    configs['vide'] = (data_format, parse_hvcc(entry[data_start:atom_end]))
+        elif handler == 'soun':
+            # 28 bytes of AudioSampleEntry (plus 16 or 36 bytes of QuickTime v1/v2)
+            version = struct.unpack('>H', entry[16:18])[0]
+            start = 8 + 28 + {1: 16, 2: 36}.get(version, 0)
+            esds = find_atom(entry, start, len(entry), ('esds',))
+            if esds is None:
+                esds = find_atom(entry, start, len(entry), ('wave', 'esds'))
+            if esds is not None:
+                configs['soun'] = (data_format, parse_esds(entry[esds[2]:esds[3]]))
+
+    return configs
+
+
+def adts_header(audio_specific_config, frame_length):
+    # 7 bytes of ADTS header without CRC, frame_length includes the header
+    audio_object_type = (audio_specific_config[0] & 0b11111000) >> 3
+    sampling_frequency_index = ((audio_specific_config[0] & 0b00000111) << 1) | ((audio_specific_config[1] & 0b10000000) >> 7)
+    channel_configuration = (audio_specific_config[1] & 0b01111000) >> 3
+    buffer_fullness = 0x7FF
+
+    return bytes([
+        0xFF,
+        0xF1, # MPEG-4, layer 0, protection_absent
+        ((audio_object_type - 1) << 6) | (sampling_frequency_index << 2) | ((channel_configuration & 0b100) >> 2),
+        ((channel_configuration & 0b011) << 6) | ((frame_length & 0b11_00000000_000) >> 11),
+        (frame_length & 0b00_11111111_000) >> 3,
+        ((frame_length & 0b00_00000000_111) << 5) | ((buffer_fullness & 0b11111_000000) >> 6),
+        ((buffer_fullness & 0b00000_111111) << 2), # number_of_raw_data_blocks_in_frame = 0
+    ])
+
+
+IOV_MAX = 1024
+
+
+def write_gather(f_dst, pieces):
+    # scatter/gather write of the list of buffers
+    if not hasattr(os, 'writev'):
+        for piece in pieces:
+            f_dst.write(piece)
+        return
 
-    # mvhd_timescale = 48000
-    # mov_timescale = 30000
-    # aac_timescale = 48000
-    mov_sample_duration = moov_const[0]
-    aac_sample_duration = moov_const[1]
-    mvhd_timescale = moov_const[2]
-    mov_timescale = moov_const[3]
-    aac_timescale = moov_const[4]
+    fd = f_dst.fileno()
+    for i in range(0, len(pieces), IOV_MAX):
+        batch = pieces[i:i+IOV_MAX]
+        n = os.writev(fd, batch)
+        if n == sum(len(piece) for piece in batch): continue
+
+        # partial write, the rest is written one by one
+        for piece in batch:
+            if n >= len(piece):
+                n -= len(piece)
+                continue
+            rest = memoryview(piece)[n:]
+            n = 0
+            while len(rest) > 0:
+                rest = rest[os.write(fd, rest):]
+
+
+def extract_elementary_streams(src_filename, tables, configs, codec, dst_prefix, n_batch=4096, verbose=False):
+    # video as Annex-B, audio as ADTS, straight from the mmap of the source
+    if is_hevc(codec):
+        video_filename = dst_prefix + '.h265'
+    else:
+        video_filename = dst_prefix + '.h264'
+    audio_filename = dst_prefix + '.aac'
+
+    with open(src_filename, 'rb') as f_in,        mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        mv = memoryview(mm)
+
+        # video : replace the NAL lengths with the start codes
+        with open(video_filename, 'wb', buffering=0) as f_dst:
+            pieces = []
+            if 'vide' in configs:
+                for parameter_set in configs['vide'][1]:
+                    pieces += [START_CODE, parameter_set]
+            for offset, size in tables['vide']:
+                end = offset + size
+                cur = offset
+                while cur + 4 <= end:
+                    n = struct.unpack_from('>I', mm, cur)[0]
+                    pieces += [START_CODE, mv[cur+4:min(cur+4+n, end)]]
+                    cur += 4 + n
+                if len(pieces) >= n_batch:
+                    write_gather(f_dst, pieces)
+                    pieces = []
+            write_gather(f_dst, pieces)
+            pieces = []
+        print(f'{len(tables["vide"])} video samples are written in {video_filename}')
+
+        # audio : put ADTS header on each raw AAC frame
+        audio_specific_config = None
+        if 'soun' in configs:
+            audio_specific_config = configs['soun'][1]
+        n_skipped = 0
+        with open(audio_filename, 'wb', buffering=0) as f_dst:
+            pieces = []
+            for offset, size in tables['soun']:
+                if audio_specific_config is not None:
+                    if size + 7 > 0b11_11111111_111:
+                        # too long for ADTS, not a single AAC frame
+                        n_skipped += 1
+                        continue
+                    pieces.append(adts_header(audio_specific_config, size + 7))
+                pieces.append(mv[offset:offset+size])
+                if len(pieces) >= n_batch:
+                    write_gather(f_dst, pieces)
+                    pieces = []
+            write_gather(f_dst, pieces)
+            pieces = []
+        print(f'{len(tables["soun"]) - n_skipped} audio frames are written in {audio_filename}')
+        if n_skipped > 0:
+            print(f'{n_skipped} audio frames are too long for ADTS and skipped')
+
+        mv.release()
 
-    n_mov_table = len(mov_table)
-    n_aac_table = len(aac_table)
 
-    mov_mdhd_duration = n_mov_table * mov_sample_duration
-    aac_mdhd_duration = n_aac_table * aac_sample_duration
-    mov_tkhd_duration = int(mov_mdhd_duration * mvhd_timescale / mov_timescale)
-    aac_tkhd_duration = int(aac_mdhd_duration * mvhd_timescale / aac_timescale)
-    if mov_tkhd_duration >= aac_tkhd_duration:
-        mvhd_duration = mov_tkhd_duration
-    else:
-        mvhd_duration = aac_tkhd_duration
+# ## merging the recovered `moov`
 
+def find_mdat_start(f_src):
+    # the source starts with 'ftyp' and 'free' followed by 'mdat'
+    # returns the position of 'mdat'
+    cur = 0
+    f_src.seek(cur)
+    n, atom_type = read_atom_head(f_src)
+    if atom_type != 'ftyp': raise ValueError('ftyp not found')
+    cur += n
+
+    f_src.seek(cur)
+    n, atom_type = read_atom_head(f_src)
+    if atom_type != 'free': raise ValueError('free not found')
+    cur += n
+
+    f_src.seek(cur)
+    n, atom_type = read_atom_head(f_src)
+    if atom_type != 'mdat': raise ValueError('mdat not found')
+
+    return cur
+
+
+def write_mdat_size(f_dst, mdat_start, mdat_size):
+    # the payload of 'mdat' stays in place, so that the sample offsets are valid
+    f_dst.seek(mdat_start)
+    if struct.unpack('>I', f_dst.read(4))[0] == 1:
+        # the source has the 64-bit size already
+        f_dst.seek(mdat_start + 8)
+        f_dst.write(struct.pack('>Q', mdat_size))
+    elif mdat_size <= 0xFFFFFFFF:
+        f_dst.seek(mdat_start)
+        f_dst.write(struct.pack('>I4s', mdat_size, b'mdat'))
+    else:
+        # the 64-bit size takes the last 8 bytes of 'free' before 'mdat'
+        f_dst.seek(0)
+        free_start, _ = read_atom_head(f_dst)
+        free_size = mdat_start - free_start
+        if free_size != 8 and free_size < 16:
+            raise ValueError(f'no room for the 64-bit size of mdat in free of {free_size} bytes')
+        if free_size > 8:
+            f_dst.seek(free_start)
+            f_dst.write(struct.pack('>I4s', free_size - 8, b'free'))
+        f_dst.seek(mdat_start - 8)
+        f_dst.write(struct.pack('>I4sQ', 1, b'mdat', mdat_size + 8))
+
+
+def append_moov(f_dst, file_size, mdat_start, moov_filename, n_chunk=65536, verbose=False):
+    # the source is copied in f_dst as it is, and f_dst is readable
+    # 'mdat' is extended to the end of the source (plus 8 bytes),
+    # and the moov is written after it
+    write_mdat_size(f_dst, mdat_start, file_size - mdat_start + 8)
+    f_dst.seek(file_size + 8)
+
+    with open(moov_filename, 'rb') as f_moov:
+        # search moov
+        f_moov.seek(0, 2)
+        moov_size = f_moov.tell()
+        if verbose:
+            print(f'moov_size: {moov_size}')
 
-    sample_size_tables = []
-    sample_size_tables.append([s for o, s in mov_table])
-    sample_size_tables.append([s for o, s in aac_table])
+        f_moov.seek(0)
+        n, atom_type = read_atom_head(f_moov)
+        if atom_type != 'moov': raise ValueError(f'something is wrong...')
 
-    chunk_offset_tables = []
-    chunk_offset_tables.append([o for o, s in mov_table])
-    chunk_offset_tables.append([o for o, s in aac_table])
+        # copy moov
+        f_moov.seek(0)
+        for moov_cur in range(0, moov_size, n_chunk):
+            f_dst.write(f_moov.read(n_chunk))
 
 
-    # moov structure is assumed to be in the fixed format (for now)
-    mov_stsz_size = len(sample_size_tables[0])* 4 + 20
-    aac_stsz_size = len(sample_size_tables[1])* 4 + 20
+def merge_moov(
+    src_filename,
+    moov_filename,
+    dst_filename,
+    n_chunk=65536,
+    verbose=False):
 
-    # mov_co64_size = len(chunk_offset_tables[0])* 8 + 16
-    # aac_co64_size = len(chunk_offset_tables[1])* 8 + 16
-    mov_stco_size = len(chunk_offset_tables[0])* 4 + 16
-    aac_stco_size = len(chunk_offset_tables[1])* 4 + 16
+    with open(src_filename, 'rb') as f_src,        open(dst_filename, 'w+b') as f_dst:
 
-    mov_stss_size = ((len(sample_size_tables[0])-1)//150 + 1)* 4 + 16
+        f_src.seek(0, 2)
+        file_size = f_src.tell()
 
+        mdat_start = find_mdat_start(f_src)
+        if verbose:
+            f_src.seek(0)
+            print_binaries(f_src.read(mdat_start))
 
-    # mov_stbl_size = 8 + 0x141 + 0x18 + 0x1C + mov_stsz_size + mov_co64_size + mov_stss_size
-    # aac_stbl_size = 8 + 0x82  + 0x18 + 0x1C + aac_stsz_size + aac_co64_size
-    mov_stbl_size = 8 + 0xAB + 0x18 + 0x1C + mov_stsz_size + mov_stco_size + mov_stss_size
-    aac_stbl_size = 8 + 0x67  + 0x18 + 0x14B75C + aac_stsz_size + aac_stco_size + 0x1A + 0x1C
+        # copy the whole source
+        f_src.seek(0)
+        for cur in range(0, file_size, n_chunk):
+            f_dst.write(f_src.read(n_chunk))
+        print('')
 
-    mov_minf_size = 8 + 0x14 + 0x24 + mov_stbl_size
-    aac_minf_size = 8 + 0x10 + 0x24 + aac_stbl_size
+        append_moov(f_dst, file_size, mdat_start, moov_filename, n_chunk, verbose)
 
-    # mov_mdia_size = 8 + 0x20 + 0x2E + mov_minf_size
-    # aac_mdia_size = 8 + 0x20 + 0x2E + aac_minf_size
-    mov_mdia_size = 8 + 0x20 + 0x2D + mov_minf_size
-    aac_mdia_size = 8 + 0x20 + 0x2D + aac_minf_size
 
-    # mov_trak_size = 8 + 0x5C + 0x24 + mov_mdia_size + 0x618
-    # aac_trak_size = 8 + 0x5C + 0x24 + aac_mdia_size
-    mov_trak_size = 8 + 0x5C + 0x24 + mov_mdia_size
-    aac_trak_size = 8 + 0x5C + 0x30 + aac_mdia_size
+# ## trimming the recovered samples into clips
 
-    # moov_size = 8 + 0x6C + 0x73 + mov_trak_size + aac_trak_size
-    # moov_size = 8 + 0x6C + 0x62 + mov_trak_size + aac_trak_size
-    moov_size = 8 + 0x6C + 0x62 + mov_trak_size
+def clip_data_range(tables, first, last):
+    # [range_start, range_end) of the source for the video samples [first, last),
+    # which is up to the end of the last sample for the last clip
+    vide = tables['vide']
+    range_start = vide[first][0]
+    if last < len(vide):
+        range_end = vide[last][0]
+    else:
+        range_end = max(table[-1][0] + table[-1][1]
+                        for handler, table in tables.items()
+                        if handler not in ('sync', 'skipped') and len(table) > 0)
+    return range_start, range_end
+
+
+def clip_sample_tables(tables, first, last, data_start):
+    # the video samples [first, last) (0-based) and the samples of the other
+    # tracks between them, with the offsets rebased to the mdat of the clip
+    # whose payload starts at data_start
+    # returns (clip tables, range_start, range_end) of the source
+    range_start, range_end = clip_data_range(tables, first, last)
+
+    clip = {
+        'sync': [number - first for number in tables['sync'] if first < number <= last],
+        'skipped': [],
+    }
+    for handler, table in tables.items():
+        if handler in ('sync', 'skipped'): continue
+        # the samples are in the order of offsets
+        i0 = bisect.bisect_left(table, (range_start,))
+        i1 = bisect.bisect_left(table, (range_end,))
+        clip[handler] = [(offset - range_start + data_start, size)
+                         for offset, size in table[i0:i1] if offset + size <= range_end]
+    return clip, range_start, range_end
+
+
+def mdat_header_size(range_start, range_end):
+    # 64-bit size if the clip is larger than 4 GiB
+    if range_end - range_start + 8 > 0xFFFFFFFF: return 16
+    return 8
+
+
+def copy_file_range(f_src, f_dst, start, length, n_chunk=1 << 20):
+    # in the kernel if possible
+    f_dst.flush()
+    f_src.seek(start)
+    if hasattr(os, 'copy_file_range'):
+        offset = start
+        while length > 0:
+            try:
+                n = os.copy_file_range(f_src.fileno(), f_dst.fileno(), length, offset)
+            except OSError:
+                break
+            if n == 0: break
+            offset += n
+            length -= n
+        f_src.seek(offset)
+    while length > 0:
+        buf = f_src.read(min(n_chunk, length))
+        if len(buf) == 0: break
+        f_dst.write(buf)
+        length -= len(buf)
 
 
-    with open(ref_filename, 'rb') as f_moov,        open(dst_filename, 'wb') as f_dst:
+def write_clip(src_filename, moov, dst_filename, range_start, range_end):
+    # ftyp and free of the source, mdat of [range_start, range_end) of the source,
+    # and the rebuilt moov (Box)
+    with open(src_filename, 'rb') as f_src,        open(dst_filename, 'wb') as f_dst:
 
-        f_moov.seek(0, 2)
-        file_size = f_moov.tell()
+        mdat_start = find_mdat_start(f_src)
+        f_src.seek(0)
+        f_dst.write(f_src.read(mdat_start))
 
-        cur = 0
-        f_moov.seek(cur)
-        if f_moov.tell() != cur: raise ValueError(f'seek failed? {f_moov.tell()} != {cur}')
-
-        # moov
-        copy_atom_box('moov', moov_size, f_moov, f_dst, only_header=True)
-
-        #copy_atom_box('mvhd', None, f_moov, f_dst, only_header=False)
-        # mvhd : duration = mov_tkhd_duration
-        n = copy_atom_box('mvhd', None, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        # the following is unchanged
-        f_dst.write(buf[:12])
-        f_dst.write(struct.pack('>I', mvhd_timescale))
-        #duration           = struct.unpack('>I', buf[16:20])[0]
-        # f_dst.write(struct.pack('>I', mov_tkhd_duration))
-        f_dst.write(struct.pack('>I', mvhd_duration))
-        # the rest is unchanged
-        f_dst.write(buf[20:])
-        #...
-        #next_track_id      = struct.unpack('>I', buf[96:100])[0]
-        if n != (100+8): raise ValueError(f'ERROR: mov tkhd box size is not 108 but {n}')
-
-        #copy_atom_box('udta', None, f_moov, f_dst, only_header=False)
-
-        # movie track
-        # trak
-        copy_atom_box('trak', mov_trak_size, f_moov, f_dst, only_header=True)
-
-        #copy_atom_box('tkhd', None, f_moov, f_dst, only_header=False)
-        # tkhd : duration = mov_tkhd_duration
-        n = copy_atom_box('tkhd', None, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        # the following is unchanged
-        f_dst.write(buf[:20])
-        #duration           = struct.unpack('>I', buf[20:24])[0]
-        f_dst.write(struct.pack('>I', mov_tkhd_duration))
-        # the rest is unchanged
-        f_dst.write(buf[24:76])
-        #...
-        f_dst.write(struct.pack('>I', 83886080))
-        f_dst.write(struct.pack('>I', 47185920))
-        #track_height       = struct.unpack('>I', buf[80:84])[0]
-        if n != (84+8): raise ValueError(f'ERROR: mov tkhd box size is not 92 but {n}')
-
-        # copy_atom_box('edts', None, f_moov, f_dst, only_header=False)
-        copy_atom_box('edts', None, f_moov, f_dst, only_header=True)
-
-        n = copy_atom_box('elst', None, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        f_dst.write(buf[:8])
-        f_dst.write(struct.pack('>I', mov_tkhd_duration))
-        f_dst.write(buf[12:])
-        if n != (20+8): raise ValueError(f'ERROR: mov elst box size is not 28 but {n}')
-
-        # mdia
-        copy_atom_box('mdia', mov_mdia_size, f_moov, f_dst, only_header=True)
-
-        #copy_atom_box('mdhd', None, f_moov, f_dst, only_header=False)
-        # mdhd : duration = mov_mdhd_duration
-        n = copy_atom_box('mdhd', None, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        # the following is unchanged
-        f_dst.write(buf[:16])
-        #duration           = struct.unpack('>I', buf[16:20])[0]
-        f_dst.write(struct.pack('>I', mov_mdhd_duration))
-        # the rest is unchanged
-        f_dst.write(buf[20:])
-        #...
-        #quality            = struct.unpack('>H', buf[22:24])[0]
-        if n != (24+8): raise ValueError(f'ERROR: mov mdhd box size is not 32 but {n}')
-
-        copy_atom_box('hdlr', None, f_moov, f_dst, only_header=False)
-
-        # minf
-        copy_atom_box('minf', mov_minf_size, f_moov, f_dst, only_header=True)
-        copy_atom_box('vmhd', None, f_moov, f_dst, only_header=False)
-        copy_atom_box('dinf', None, f_moov, f_dst, only_header=False)
-
-        # stbl
-        copy_atom_box('stbl', mov_stbl_size, f_moov, f_dst, only_header=True)
-        copy_atom_box('stsd', None, f_moov, f_dst, only_header=False)
-
-        #copy_atom_box('stts', None, f_moov, f_dst, only_header=False)
-        # stts : sample_count = n_mov_table
-        n = copy_atom_box('stts', None, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        f_dst.write(buf[:4]) # version + flags
-        f_dst.write(struct.pack('>I', 1)) # n_entries
-        f_dst.write(struct.pack('>I', n_mov_table)) # sample_count
-        f_dst.write(struct.pack('>I', mov_sample_duration)) # sample_duration
-
-        # stss
-        n = copy_atom_box('stss', mov_stss_size, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        f_dst.write(buf[:4]) # version + flags
-        mov_stss_entries = (len(sample_size_tables[0])-1)//150 + 1
-        f_dst.write(struct.pack('>I', mov_stss_entries)) # n_entries
-        ss = 1
-        for i_ss in range(mov_stss_entries):
-            f_dst.write(struct.pack('>I', ss))
-            ss += 150
-
-        copy_atom_box('stsc', None, f_moov, f_dst, only_header=False)
-
-        # stsz
-        n = copy_atom_box('stsz', mov_stsz_size, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        f_dst.write(buf[:4]) # version + flags
-        f_dst.write(struct.pack('>I', 0)) # sample_size
-        f_dst.write(struct.pack('>I', len(sample_size_tables[0]))) # n_entries
-        for sz in sample_size_tables[0]:
-            f_dst.write(struct.pack('>I', sz))
-
-        # co64
-        # n = copy_atom_box('co64', mov_co64_size, f_moov, f_dst, only_header=True)
-        # buf = f_moov.read(n-8)
-        # f_dst.write(buf[:4]) # version + flags
-        # f_dst.write(struct.pack('>I', len(chunk_offset_tables[0]))) # n_entries
-        # for co in chunk_offset_tables[0]:
-        #     f_dst.write(struct.pack('>Q', co))
-        n = copy_atom_box('stco', mov_stco_size, f_moov, f_dst, only_header=True)
-        buf = f_moov.read(n-8)
-        f_dst.write(buf[:4]) # version + flags
-        f_dst.write(struct.pack('>I', len(chunk_offset_tables[0]))) # n_entries
-        for co in chunk_offset_tables[0]:
-            f_dst.write(struct.pack('>I', co))
-
-        # uuid
-        # copy_atom_box('uuid', None, f_moov, f_dst, only_header=False)
-
-
-        # # audio track
-        # # trak
-        # copy_atom_box('trak', aac_trak_size, f_moov, f_dst, only_header=True)
-
-        # #copy_atom_box('tkhd', None, f_moov, f_dst, only_header=False)
-        # # tkhd : duration = aac_mdhd_duration
-        # n = copy_atom_box('tkhd', None, f_moov, f_dst, only_header=True)
-        # buf = f_moov.read(n-8)
-        # # the following is unchanged
-        # f_dst.write(buf[:20])
-        # #duration           = struct.unpack('>I', buf[20:24])[0]
-        # f_dst.write(struct.pack('>I', aac_mdhd_duration))
-        # # the rest is unchanged
-        # f_dst.write(buf[24:])
-        # #...
-        # #track_height       = struct.unpack('>I', buf[80:84])[0]
-        # if n != (84+8): raise ValueError(f'ERROR: audio tkhd box size is not 92 but {n}')
-
-        # # copy_atom_box('edts', None, f_moov, f_dst, only_header=False)
-        # copy_atom_box('edts', None, f_moov, f_dst, only_header=True)
-
-        # n = copy_atom_box('elst', None, f_moov, f_dst, only_header=True)
-        # buf = f_moov.read(n-8)
-        # f_dst.write(buf[:12])
-        # f_dst.write(struct.pack('>I', aac_tkhd_duration))
-        # f_dst.write(buf[16:])
-        # if n != (32+8): raise ValueError(f'ERROR: mov elst box size is not 40 but {n}')
-
-        # # mdia
-        # copy_atom_box('mdia', aac_mdia_size, f_moov, f_dst, only_header=True)
-
-        # #copy_atom_box('mdhd', None, f_moov, f_dst, only_header=False)
-        # # mdhd : duration = aac_mdhd_duration
-        # n = copy_atom_box('mdhd', None, f_moov, f_dst, only_header=True)
-        # buf = f_moov.read(n-8)
-        # # the following is unchanged
-        # f_dst.write(buf[:16])
-        # #duration           = struct.unpack('>I', buf[16:20])[0]
-        # f_dst.write(struct.pack('>I', aac_mdhd_duration))
-        # # the rest is unchanged
-        # f_dst.write(buf[20:])
-        # #...
-        # #quality            = struct.unpack('>H', buf[22:24])[0]
-        # if n != (24+8): raise ValueError(f'ERROR: audio mdhd box size is not 32 but {n}')
-
-        # copy_atom_box('hdlr', None, f_moov, f_dst, only_header=False)
-
-        # # minf
-        # copy_atom_box('minf', aac_minf_size, f_moov, f_dst, only_header=True)
-        # copy_atom_box('smhd', None, f_moov, f_dst, only_header=False)
-        # copy_atom_box('dinf', None, f_moov, f_dst, only_header=False)
-
-        # # stbl
-        # copy_atom_box('stbl', aac_stbl_size, f_moov, f_dst, only_header=True)
-        # copy_atom_box('stsd', None, f_moov, f_dst, only_header=False)
-
-        # #copy_atom_box('stts', None, f_moov, f_dst, only_header=False)
-        # # stts : sample_count = n_aac_table
-        # n = copy_atom_box('stts', None, f_moov, f_dst, only_header=True)
-        # buf = f_moov.read(n-8)
-        # f_dst.write(buf[:4]) # version + flags
-        # f_dst.write(struct.pack('>I', 1)) # n_entries
-        # f_dst.write(struct.pack('>I', n_aac_table)) # sample_count
-        # f_dst.write(struct.pack('>I', aac_sample_duration)) # sample_duration
-
-        # # copy_atom_box('stsc', None, f_moov, f_dst, only_header=False)
-        # cur = f_dst.tell()
-        # n = copy_atom_box('stsc', None, f_moov, f_dst, only_header=True)
-        # f_dst.seek(cur)
-        # f_dst.write(struct.pack('>I', 28))
-        # f_dst.seek(cur+8)
-        # buf = f_moov.read(n-8)
-        # f_dst.write(buf[:4]) # version + flags
-        # f_dst.write(struct.pack('>I', 1)) # n_entries
-        # f_dst.write(struct.pack('>I', 1))
-        # f_dst.write(struct.pack('>I', 1))
-        # f_dst.write(struct.pack('>I', 1))
-
-        # # stsz
-        # n = copy_atom_box('stsz', aac_stsz_size, f_moov, f_dst, only_header=True)
-        # buf = f_moov.read(n-8)
-        # f_dst.write(buf[:4]) # version + flags
-        # f_dst.write(struct.pack('>I', 0)) # sample_size
-        # f_dst.write(struct.pack('>I', len(sample_size_tables[1]))) # n_entries
-        # for sz in sample_size_tables[1]:
-        #     f_dst.write(struct.pack('>I', sz))
-
-        # # co64
-        # # n = copy_atom_box('co64', aac_co64_size, f_moov, f_dst, only_header=True)
-        # # buf = f_moov.read(n-8)
-        # # f_dst.write(buf[:4]) # version + flags
-        # # f_dst.write(struct.pack('>I', len(chunk_offset_tables[1]))) # n_entries
-        # # for co in chunk_offset_tables[1]:
-        # #     f_dst.write(struct.pack('>Q', co))
-        # n = copy_atom_box('stco', aac_stco_size, f_moov, f_dst, only_header=True)
-        # buf = f_moov.read(n-8)
-        # f_dst.write(buf[:4]) # version + flags
-        # f_dst.write(struct.pack('>I', len(chunk_offset_tables[1]))) # n_entries
-        # for co in chunk_offset_tables[1]:
-        #     f_dst.write(struct.pack('>I', co))
-
-        # copy_atom_box('sgpd', None, f_moov, f_dst, only_header=False)
-
-        # copy_atom_box('sbgp', None, f_moov, f_dst, only_header=False)
-
-        # to skip the audio track
-        print_atom_headers(f_moov)
-
-        copy_atom_box('udta', None, f_moov, f_dst, only_header=False)
-
-        if not full_copy: return
-
-        # just copy the rest of reference moov file
-        moov_cur = f_moov.tell()
-        f_moov.seek(0, 2)
-        moov_size = f_moov.tell()
-        f_moov.seek(moov_cur)
-        if f_moov.tell() != moov_cur: raise ValueError(f'seek failed? {f_moov.tell()} != {moov_cur}')
-        if verbose:
-            it_moov = tqdm(range(moov_cur, moov_size, n_chunk))
+        size = range_end - range_start
+        if mdat_header_size(range_start, range_end) == 16:
+            f_dst.write(struct.pack('>I4sQ', 1, b'mdat', size + 16))
         else:
-            it_moov = range(moov_cur, moov_size, n_chunk)
-        #for moov_cur in tqdm(range(moov_cur, moov_size, n_chunk)):
-        for moov_cur in it_moov:
-            f_dst.write(f_moov.read(n_chunk))
-        if moov_size - moov_cur > 0:
-            f_dst.write(f_moov.read(moov_size - moov_cur))
+            f_dst.write(struct.pack('>I4s', size + 8, b'mdat'))
+        copy_file_range(f_src, f_dst, range_start, size)
 
+        f_dst.flush()
+        write_gather(f_dst, list(moov.iter_pieces()))
 
-# ## merging the recovered `moov`
 
-def merge_moov(
-    src_filename,
-    moov_filename,
-    dst_filename,
-    n_chunk=65536,
-    verbose=False):
+def recovered_index(tables, moov_const):
+    # SampleIndex of the recovered video samples
+    return SampleIndex.from_recovered(tables['vide'], moov_const[0], moov_const[3], tables['sync'])
 
-    with open(src_filename, 'rb') as f_src,        open(moov_filename, 'rb') as f_moov,        open(dst_filename, 'wb') as f_dst:
 
-        f_src.seek(0, 2)
-        file_size = f_src.tell()
+def clip_range(tables, moov_const, start, end):
+    # the video samples [first, last) (0-based) from the time start to end,
+    # where first is snapped back to the sync sample
+    index = recovered_index(tables, moov_const)
+    first = index.keyframe_before(index.sample_at(start)) - 1
+    # up to the sample which contains end
+    number = index.sample_at(end)
+    last = number if index.time(number) < end else number - 1
+    last = min(max(last, first + 1), index.n_samples)
+    return first, last
 
-        cur = 0
-        f_src.seek(cur)
-        if f_src.tell() != cur: raise ValueError(f'seek failed? {f_src.tell()} != {cur}')
 
-        # ftyp
-        n, atom_type = read_atom_head(f_src)
-        if atom_type != 'ftyp': raise ValueError('ftyp not found')
+def write_clip_of_samples(moov_const, src_filename, ref_buf, dst_filename, tables, first, last, verbose=False):
+    # write the clip of the video samples [first, last) with its own moov
+    # the size of the mdat header is decided by the same range as written
+    range_start, range_end = clip_data_range(tables, first, last)
+    with open(src_filename, 'rb') as f_src:
+        mdat_start = find_mdat_start(f_src)
+    data_start = mdat_start + mdat_header_size(range_start, range_end)
+    clip, _, _ = clip_sample_tables(tables, first, last, data_start)
+    moov = build_moov(moov_const, ref_buf, clip, verbose=verbose)
+    write_clip(src_filename, moov, dst_filename, range_start, range_end)
+    return range_end - range_start
 
-        f_src.seek(cur)
-        if f_src.tell() != cur: raise ValueError(f'seek failed? {f_src.tell()} != {cur}')
-        buf = f_src.read(n)
-        f_dst.write(buf)
-        if verbose:
-            print_binaries(buf)
-        cur += n
 
-        # cur += 16
-        # free
-        n, atom_type = read_atom_head(f_src)
-        if atom_type != 'free': raise ValueError('ftyp not found')
+def trim_mp4(
+    moov_const,
+    src_filename,
+    ref_moov_filename,
+    dst_filename,
+    tables,
+    start,
+    end,
+    verbose=False):
+    # write the clip of the time range [start, end) in seconds
+    first, last = clip_range(tables, moov_const, start, end)
+
+    with open(ref_moov_filename, 'rb') as f_moov:
+        ref_buf = f_moov.read()
+    n = write_clip_of_samples(moov_const, src_filename, ref_buf, dst_filename, tables, first, last, verbose)
+    print(f'clip : video samples {first+1} - {last} ({first * moov_const[0] / moov_const[3]:.3f} sec -'
+          f' {last * moov_const[0] / moov_const[3]:.3f} sec), {n} bytes')
+
+
+def segment_ranges(tables, moov_const, max_bytes=None, max_seconds=None):
+    # split the video samples at the sync samples into [(first, last)],
+    # so that each segment is within max_bytes of mdat and max_seconds
+    vide = tables['vide']
+    n_samples = len(vide)
+    max_samples = None
+    if max_seconds is not None:
+        max_samples = max(1, int(max_seconds * moov_const[3] / moov_const[0]))
+
+    # moov takes about 8 bytes (stsz and stco) for each sample of all tracks,
+    # and the other atoms are within the allowance
+    n_all = sum(len(table) for handler, table in tables.items() if handler not in ('sync', 'skipped'))
+    table_bytes = 8 * n_all / max(n_samples, 1)
+    allowance = 64 << 10
+
+    def too_long(first, last):
+        if max_samples is not None and last - first > max_samples: return True
+        if max_bytes is not None:
+            end = vide[last][0] if last < n_samples else vide[-1][0] + vide[-1][1]
+            size = end - vide[first][0] + table_bytes * (last - first) + allowance
+            if size > max_bytes: return True
+        return False
 
-        f_src.seek(cur)
-        if f_src.tell() != cur: raise ValueError(f'seek failed? {f_src.tell()} != {cur}')
-        buf = f_src.read(n)
-        f_dst.write(buf)
-        if verbose:
-            print_binaries(buf)
-        cur += n
-        # mdat
+    ranges = []
+    first = 0
+    boundary = 0
+    for number in tables['sync'] + [n_samples + 1]:
+        last = number - 1
+        if last <= first: continue
+        if too_long(first, last) and boundary > first:
+            ranges.append((first, boundary))
+            first = boundary
+        boundary = last
+    if first < n_samples:
+        ranges.append((first, n_samples))
+    return ranges
+
+
+def split_mp4(
+    moov_const,
+    src_filename,
+    ref_moov_filename,
+    dst_filename,
+    tables,
+    max_bytes=None,
+    max_seconds=None,
+    max_workers=4,
+    verbose=False):
+    # write the segments as dst_001.mp4, dst_002.mp4, ... by the workers,
+    # each of which reads its own range of the source
+    # returns the segment filenames
+    with open(ref_moov_filename, 'rb') as f_moov:
+        ref_buf = f_moov.read()
+
+    ranges = segment_ranges(tables, moov_const, max_bytes, max_seconds)
+    root, ext = os.path.splitext(dst_filename)
+    filenames = [f'{root}_{i+1:03d}{ext}' for i in range(len(ranges))]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(write_clip_of_samples, moov_const, src_filename, ref_buf,
+                            filename, tables, first, last, verbose)
+            for filename, (first, last) in zip(filenames, ranges)]
+        for filename, (first, last), future in zip(filenames, ranges, futures):
+            n = future.result()
+            print(f'{filename} : video samples {first+1} - {last}'
+                  f' ({(last - first) * moov_const[0] / moov_const[3]:.3f} sec), {n} bytes')
+
+    return filenames
+
+
+# ## writing the reference movie
+#
+# the movie has only ftyp and moov, and its samples are read from the
+# source files through the data references ('url ' in dref) of each track
+
+def join_chapters(chapters):
+    # chapters is [(filename, tables)], and returns the tables of the timeline
+    # and the number of samples in each chapter by handler type
+    joined = {'vide': [], 'sync': [], 'skipped': []}
+    counts = []
+    for filename, tables in chapters:
+        count = {}
+        for handler, table in tables.items():
+            if handler in ('sync', 'skipped'): continue
+            count[handler] = len(table)
+        joined['sync'] += [number + len(joined['vide']) for number in tables['sync']]
+        for handler in count:
+            joined.setdefault(handler, [])
+            joined[handler] += tables[handler]
+        counts.append(count)
+    return joined, counts
+
+
+def write_reference_movie(moov_const, ref_moov_filename, dst_filename, chapters, verbose=False):
+    # the urls are relative to the movie
+    dst_dir = os.path.dirname(os.path.abspath(dst_filename))
+    drefs = [urllib.parse.quote(os.path.relpath(os.path.abspath(filename), dst_dir))
+             for filename, _ in chapters]
+    tables, counts = join_chapters(chapters)
+
+    with open(ref_moov_filename, 'rb') as f_moov:
+        buf = f_moov.read()
+    moov = build_moov(moov_const, buf, tables, verbose=verbose, drefs=drefs, chapters=counts)
+
+    with open(chapters[0][0], 'rb') as f_src:
         n, atom_type = read_atom_head(f_src)
-        if atom_type != 'mdat': raise ValueError('mdat not found')
+        if atom_type != 'ftyp': raise ValueError('ftyp not found')
+        f_src.seek(0)
+        ftyp = f_src.read(n)
+
+    with open(dst_filename, 'wb') as f_dst:
+        f_dst.write(ftyp)
+        f_dst.flush()
+        write_gather(f_dst, list(moov.iter_pieces()))
+
+    print(f'{dst_filename} : {len(ftyp) + moov.size} bytes, referring to')
+    for url in drefs:
+        print(f'\t{url}')
+
+
+# ## following the source being copied
+#
+# as tail -f, the source is scanned pass by pass while it is growing.
+# each pass starts at the pending video sample, and the last video sample
+# found and the samples after it, which may not be complete yet, are left
+# pending for the next pass
+
+FOLLOW_INTERVAL = 1.0
+FOLLOW_IDLE = 10.0
+
+def hold_back_samples(tables):
+    # returns the tables of the samples before the last video sample,
+    # and the offset of the last video sample, or (None, None) without two of them
+    video = tables['vide']
+    if len(video) < 2: return None, None
+    pending = video[-1][0]
+    held = {}
+    for handler, table in tables.items():
+        if handler == 'sync':
+            held[handler] = [number for number in table if number < len(video)]
+        else:
+            held[handler] = [(offset, size) for offset, size in table if offset < pending]
+    return held, pending
+
+
+def follow_sample_tables(
+    filename,
+    rules=None,
+    split_aac=False,
+    salvage=False,
+    copy_to=None,
+    interval=FOLLOW_INTERVAL,
+    idle=FOLLOW_IDLE,
+    verbose=False):
+    # returns the sample tables as recover_sample_tables_from_mdat_fast()
+    # after the size of the source is unchanged for idle seconds
+    # with copy_to, the source is copied to it up to the pending sample in each pass,
+    # and to the end after the last pass
+    tables = None
+    cur = None
+    copied = 0
+    size = -1
+    last_change = time.time()
+    with open(filename, 'rb') as f_src:
+        while True:
+            new_size = os.path.getsize(filename)
+            now = time.time()
+            changed = new_size != size
+            if changed:
+                size = new_size
+                last_change = now
+            final = now - last_change >= idle
+            if not changed and not final:
+                time.sleep(interval)
+                continue
+
+            if cur is None:
+                # until the header of 'mdat' is written
+                try:
+                    cur, _ = find_mdat(f_src)
+                except (ValueError, struct.error):
+                    if final: raise
+                    time.sleep(interval)
+                    continue
+                tables = {handler: [] for handler in ('vide', 'soun', 'sync', 'skipped')}
+                data_start = cur
+
+            part = recover_sample_tables_from_mdat_fast(
+                filename,
+                rules,
+                split_aac=split_aac,
+                salvage=salvage,
+                start=cur)
+
+            if final:
+                pending = size
+            else:
+                part, pending = hold_back_samples(part)
+                # the pending sample is found again only when it is complete
+                if part is None or (cur > data_start and part['vide'][0][0] != cur):
+                    time.sleep(interval)
+                    continue
+
+            n_video = len(tables['vide'])
+            for handler, table in part.items():
+                if handler == 'sync':
+                    tables['sync'] += [number + n_video for number in table]
+                else:
+                    tables.setdefault(handler, [])
+                    tables[handler] += table
+            cur = pending
+
+            if copy_to is not None:
+                copy_file_range(f_src, copy_to, copied, pending - copied)
+                copied = pending
+            if verbose:
+                log.info('%d / %d bytes : %d video samples', pending, size, len(tables['vide']))
+            if final: break
+            time.sleep(interval)
+
+    return tables
+
+
+# ## verifying the recovered file
+
+def check_video_sample(mm, offset, size, video_signature, codec):
+    if not match_signature(mm[offset:offset+video_signature[2]], video_signature):
+        return 'no access unit delimiter'
+
+    # the NAL lengths must end exactly at the end of the sample
+    end = offset + size
+    cur = offset
+    while cur + 6 <= end:
+        if not is_nal_header(mm[cur+4:cur+6], codec):
+            return 'invalid NAL unit header'
+        cur += struct.unpack_from('>I', mm, cur)[0] + 4
+    if cur != end:
+        return 'broken NAL length chain'
+
+    return None
+
+
+def verify_mp4(filename, rules=None, verbose=False):
+    # check every sample of stco/stsz against mdat of the file
+    if rules is None:
+        codec = read_video_codec(filename)
+        if not codec in VIDEO_SIGNATURES: codec = 'avc1'
+        rules = default_scan_rules(codec)
+    codec = rules['codec']
+    video_signature = rules['video']
+
+    report = {
+        'ok': True,
+        'n_samples': 0,
+        'n_bytes': 0,
+        'n_bad': 0,
+        'n_gaps': 0,
+        'gap_bytes': 0,
+        'first_bad': None,
+    }
+
+    t0 = time.time()
+    with open(filename, 'rb') as f_in:
+        data_start, mdat_end = find_mdat(f_in)
+        f_in.seek(0, 2)
+        file_size = f_in.tell()
+        tracks = read_sample_tables(f_in, file_size)
+
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+            samples = []
+            bad = []
+            for i_track, track in enumerate(tracks):
+                sc_table = track['sc_table']
+                sz_table = track['sz_table']
+                co_table = track['co_table']
+                if len(sc_table) == 0 or len(sz_table) == 0 or len(co_table) == 0:
+                    continue
+
+                handler = track['handler']
+                for i_sample, (offset, size) in enumerate(iter_samples(sc_table, sz_table, co_table)):
+                    samples.append((offset, size, i_track, i_sample))
+
+                    if offset < data_start or offset + size > mdat_end:
+                        reason = 'out of mdat'
+                    elif handler == 'vide':
+                        reason = check_video_sample(mm, offset, size, video_signature, codec)
+                    elif handler == 'soun' and match_signature(mm[offset:offset+video_signature[2]], video_signature):
+                        reason = 'video sample in audio track'
+                    else:
+                        reason = None
+
+                    if reason is not None:
+                        bad.append((offset, i_track, i_sample, reason))
+
+    # overlaps and gaps between the samples of all tracks
+    samples.sort()
+    prev_end = data_start
+    for offset, size, i_track, i_sample in samples:
+        if offset < prev_end:
+            bad.append((offset, i_track, i_sample, 'overlapped with the previous sample'))
+        elif offset > prev_end:
+            report['n_gaps'] += 1
+            report['gap_bytes'] += offset - prev_end
+        prev_end = max(prev_end, offset + size)
+        report['n_bytes'] += size
+
+    report['n_samples'] = len(samples)
+    report['n_bad'] = len(bad)
+    if len(bad) > 0:
+        report['ok'] = False
+        report['first_bad'] = min(bad)
+
+    elapsed = time.time() - t0
+    if report['ok']:
+        print(f'verify : PASS ({report["n_samples"]} samples)')
+    else:
+        offset, i_track, i_sample, reason = report['first_bad']
+        print(f'verify : FAIL ({report["n_bad"]} bad samples in {report["n_samples"]})')
+        print(f'first bad sample : track {i_track} sample {i_sample} at 0x{offset:X} : {reason}')
+    if report['n_gaps'] > 0:
+        print(f'gaps   : {report["n_gaps"]} ({report["gap_bytes"]} bytes)')
+    if verbose and elapsed > 0:
+        print(f'{report["n_bytes"]/elapsed/1e9:.2f} GB/s in {elapsed:.3f} sec')
+
+    return report
+
+
+# ## choosing the reference
+#
+# the references in the library are indexed by the parameter sets of the video
+# (SPS and PPS, and VPS of H.265), which are also found in band at the sync
+# samples in mdat, so that the reference is found by a lookup of the dict.
+# the resolution is in SPS, while the timescale and the audio configuration,
+# which are not in mdat, are kept in the entries for information
+
+# the parameter sets are looked for in this many bytes from the start of mdat
+FINGERPRINT_PROBE = 4 << 20
+
+def is_parameter_set_nal(buf, codec):
+    # SPS, PPS (H.264), or VPS, SPS, PPS (H.265)
+    if is_hevc(codec):
+        return 32 <= (buf[0] & 0b01111110) >> 1 <= 34
+    else:
+        return 7 <= (buf[0] & 0x1F) <= 8
 
-        # if n != 0: raise ValueError('size would be zero...')
 
-        # # fixed mdat header
-        # if verbose:
-        #     print_binaries(struct.pack('>Icccc', 1, b'm', b'd', b'a', b't'))
-        #     print_binaries(struct.pack('>Q', file_size-0x20))
-        # f_dst.write(struct.pack('>Icccc', 1, b'm', b'd', b'a', b't'))
-        # f_dst.write(struct.pack('>Q', file_size-0x20))
+def fingerprint_key(codec, parameter_sets):
+    # 'avc' or 'hevc', since the sample entry format is not known in band
+    # the other NAL units in hvcC (SEI, ...) are not in the key
+    family = 'hevc' if is_hevc(codec) else 'avc'
+    return family + ':' + ','.join(sorted(
+        bytes(parameter_set).hex() for parameter_set in parameter_sets
+        if len(parameter_set) >= 2 and is_parameter_set_nal(parameter_set[:2], codec)))
 
-        # cur += 16
-        f_src.seek(cur)
-        if f_src.tell() != cur: raise ValueError(f'seek failed? {f_src.tell()} != {cur}')
-        if verbose:
-            it_cur = tqdm(range(cur, file_size, n_chunk))
-        else:
-            it_cur = range(cur, file_size, n_chunk)
-        #for cur in tqdm(range(cur, file_size, n_chunk)):
-        for cur in it_cur:
-            f_dst.write(f_src.read(n_chunk))
-        if file_size - cur > 0:
-            f_dst.write(f_src.read(file_size - cur))
-        print('')
 
-        temp = f_dst.tell()
-        f_dst.seek(40)
-        f_dst.write(struct.pack('>Icccc', file_size - 0x20, b'm', b'd', b'a', b't'))
-        f_dst.seek(temp + 8)
+def reference_fingerprint(filename):
+    # returns (key, entry) of the healthy file, or None without the video
+    configs = read_decoder_configs(filename)
+    if 'vide' not in configs: return None
+    codec, parameter_sets = configs['vide']
 
-        # search moov
-        f_moov.seek(0, 2)
-        moov_size = f_moov.tell()
-        if verbose:
-            print(f'moov_size: {moov_size}')
+    entry = {'path': os.path.abspath(filename), 'codec': codec}
+    with open(filename, 'rb') as f_in:
+        f_in.seek(0, 2)
+        file_size = f_in.tell()
+        tracks = read_sample_tables(f_in, file_size)
+    for track in tracks:
+        if track['handler'] == 'vide' and 'width' not in entry:
+            # width and height after 8 + 24 bytes of VisualSampleEntry
+            width, height = struct.unpack('>HH', track['stsd'][8+32:8+36])
+            entry['width'] = width
+            entry['height'] = height
+            entry['video_timescale'] = track['timescale']
+        elif track['handler'] == 'soun' and 'audio_timescale' not in entry:
+            entry['audio_timescale'] = track['timescale']
+    if 'soun' in configs:
+        entry['audio'] = configs['soun'][0] + ':' + configs['soun'][1].hex()
+
+    return fingerprint_key(codec, parameter_sets), entry
+
+
+def inband_fingerprint(filename, probe_size=FINGERPRINT_PROBE):
+    # returns the key from the parameter sets at the first sync sample in mdat,
+    # or None if they are not found in probe_size bytes
+    with open(filename, 'rb') as f_in:
+        data_start, mdat_end = find_mdat(f_in)
+        end = min(mdat_end, data_start + probe_size)
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for codec in ('avc1', 'hvc1'):
+                rules = default_scan_rules(codec)
+                n_head = max(6, rules['video'][2], rules['audio'][2])
+                cur = find_video_sample(mm, data_start, end, rules, [rules['video']], n_head, sync=True)
+                if cur >= end: continue
+                frame_length, _, _ = walk_video_sample(
+                    mm, cur, end, codec, rules['audio'], [rules['video']], n_head)
+
+                parameter_sets = []
+                nal = cur
+                while nal + 6 <= cur + frame_length:
+                    nal_length = struct.unpack('>I', mm[nal:nal+4])[0]
+                    if is_parameter_set_nal(mm[nal+4:nal+6], codec):
+                        parameter_sets.append(mm[nal+4:nal+4+nal_length])
+                    nal += 4 + nal_length
+                if len(parameter_sets) > 0:
+                    return fingerprint_key(codec, parameter_sets)
+    return None
+
+
+def load_reference_library(filename):
+    # {key: [entry]}
+    with open(filename) as f_in:
+        return json.load(f_in)
+
+
+def save_reference_library(filename, library):
+    with open(filename, 'w') as f_out:
+        json.dump(library, f_out, indent=2)
+        f_out.write('\n')
+
+
+def choose_reference(library, src_filename):
+    # returns the path of the first matching reference which still exists
+    key = inband_fingerprint(src_filename)
+    if key is None: return None
+    for entry in library.get(key, []):
+        if os.path.exists(entry['path']): return entry['path']
+    return None
+
+
+# ## estimating the recoverable footage
+
+def estimate_recovery(
+    filename,
+    moov_const,
+    rules=None,
+    n_windows=32,
+    window_size=4 << 20,
+    seed=0,
+    verbose=False):
+    # scan a window at random position in each of n_windows strata of mdat,
+    # and extrapolate the sample density of the windows to the whole mdat
+    # returns the estimates and their 95% confidence bounds by handler type
+    if rules is None: rules = default_scan_rules()
 
-        moov_cur = 0
-        f_moov.seek(moov_cur)
-        if f_moov.tell() != moov_cur: raise ValueError(f'seek failed? {f_moov.tell()} != {moov_cur}')
-        n, atom_type = read_atom_head(f_moov)
-        if atom_type != 'moov': raise ValueError(f'something is wrong...')
+    with open(filename, 'rb') as f_in:
+        data_start, mdat_end = find_mdat(f_in)
+    mdat_size = mdat_end - data_start
 
-        # copy moov
-        f_moov.seek(moov_cur)
-        if f_moov.tell() != moov_cur: raise ValueError(f'seek failed? {f_moov.tell()} != {moov_cur}')
+    windows = []
+    if n_windows * window_size >= mdat_size:
+        # small enough to scan it all
+        windows.append((data_start, mdat_end))
+    else:
+        rng = random.Random(seed)
+        stratum = mdat_size / n_windows
+        for i in range(n_windows):
+            stratum_start = data_start + int(i * stratum)
+            stratum_end = data_start + int((i+1) * stratum)
+            window_start = rng.randrange(stratum_start, max(stratum_start+1, stratum_end - window_size))
+            windows.append((window_start, min(window_start + window_size, mdat_end)))
+
+    # samples per byte of each window
+    # n_read counts the bytes scanned, up to the end of the last sample
+    # which may run over the window
+    densities = {'vide': [], 'soun': []}
+    n_read = 0
+    for window_start, window_end in windows:
+        tables = recover_sample_tables_from_mdat_fast(
+            filename,
+            rules,
+            split_aac=True,
+            start=window_start,
+            end=window_end)
+        # the bytes before the first video sample are not scanned
+        if len(tables['vide']) > 0:
+            scanned = window_end - min(window_end, max(window_start, tables['vide'][0][0]))
+        else:
+            scanned = 0
+        for handler in densities:
+            if scanned <= 0:
+                densities[handler].append(0.0)
+            else:
+                n = sum(1 for offset, _ in tables[handler] if offset < window_end)
+                densities[handler].append(n / scanned)
+        scanned_end = max([window_end] + [table[-1][0] + table[-1][1]
+                                          for handler, table in tables.items()
+                                          if handler not in ('sync', 'skipped') and len(table) > 0])
+        n_read += scanned_end - window_start
         if verbose:
-            it_moov = tqdm(range(moov_cur, moov_size, n_chunk))
+            print(f'[{window_start}, {window_end}) : {len(tables["vide"])} video samples')
+
+    # with one window per stratum, the variance is approximated
+    # by that of the simple random sampling of the windows
+    sampled = n_read / mdat_size
+    durations = {
+        'vide': moov_const[0] / moov_const[3],
+        'soun': moov_const[1] / moov_const[4],
+    }
+    report = {
+        'mdat_size': mdat_size,
+        'n_windows': len(windows),
+        'n_read': n_read,
+    }
+    for handler, values in densities.items():
+        estimate = mdat_size * statistics.mean(values)
+        if len(values) > 1:
+            error = 1.96 * mdat_size * statistics.stdev(values) * math.sqrt((1 - sampled) / len(values))
         else:
-            it_moov = range(moov_cur, moov_size, n_chunk)
-        #for moov_cur in tqdm(range(moov_cur, moov_size, n_chunk)):
-        for moov_cur in it_moov:
-            f_dst.write(f_moov.read(n_chunk))
-        if moov_size - moov_cur > 0:
-            f_dst.write(f_moov.read(moov_size - moov_cur))
+            error = 0.0
+        low = max(0.0, estimate - error)
+        high = estimate + error
+        report[handler] = {
+            'n_samples': int(round(estimate)),
+            'n_samples_low': int(round(low)),
+            'n_samples_high': int(round(high)),
+            'duration': estimate * durations[handler],
+            'duration_low': low * durations[handler],
+            'duration_high': high * durations[handler],
+        }
+
+    print(f'estimate : {len(windows)} windows, {n_read/(1<<20):.1f} MiB of {mdat_size/(1<<20):.1f} MiB'
+          f' ({100*sampled:.1f} %)')
+    for handler in densities:
+        r = report[handler]
+        print(f'  {handler} : {r["n_samples"]} samples ({r["n_samples_low"]} - {r["n_samples_high"]}),'
+              f' {r["duration"]:.1f} sec ({r["duration_low"]:.1f} - {r["duration_high"]:.1f})')
+
+    return report
 
 
 # # main program to recover corrupted MP4
 
+def run_stages(stages):
+    # stages is a list of (name, function, names of the dependencies),
+    # where a stage comes after its dependencies
+    # each stage runs on a thread as soon as its dependencies are done,
+    # with their results as the arguments
+    # returns the results and (start, end) times of the stages by name
+    futures = {}
+    timings = {}
+
+    def run(name, function, dependencies):
+        args = [futures[dependency].result() for dependency in dependencies]
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            timings[name] = (start, time.time())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        for name, function, dependencies in stages:
+            futures[name] = executor.submit(run, name, function, dependencies)
+        results = {name: future.result() for name, future in futures.items()}
+
+    return results, timings
+
+
+def print_stage_timings(stages, timings):
+    # the critical path is traced back from the last stage
+    # through the dependency which ended last
+    t0 = min(start for start, _ in timings.values())
+    dependencies = {name: deps for name, _, deps in stages}
+    width = max(len(name) for name, _, _ in stages)
+    for name, _, _ in stages:
+        start, end = timings[name]
+        print(f'{name:{width}s} : {start - t0:8.3f} - {end - t0:8.3f} sec ({end - start:.3f} sec)')
+
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while len(dependencies[path[-1]]) > 0:
+        path.append(max(dependencies[path[-1]], key=lambda name: timings[name][1]))
+    path.reverse()
+    total = timings[path[-1]][1] - t0
+    print(f'critical path : {" -> ".join(path)} ({total:.3f} sec)')
+
+
+def print_table_durations(moov_const, tables):
+    mov_sample_duration = moov_const[0]
+    aac_sample_duration = moov_const[1]
+    mvhd_timescale = moov_const[2]
+    mov_timescale = moov_const[3]
+    aac_timescale = moov_const[4]
+
+    for handler, table in tables.items():
+        if handler in ('sync', 'skipped'): continue
+        log.info('number of samples (%s) : %d', handler, len(table))
+    log.info('number of sync samples : %d', len(tables['sync']))
+
+    mov_mdhd_duration = len(tables['vide']) * mov_sample_duration
+    aac_mdhd_duration = len(tables['soun']) * aac_sample_duration
+    mov_tkhd_duration = int(mov_mdhd_duration * mvhd_timescale / mov_timescale)
+
+    # mvhd
+    mvhd_duration_sec = mov_tkhd_duration / mvhd_timescale
+    log.info('mvhd duration  : %s sec / %s min', mvhd_duration_sec, mvhd_duration_sec/60)
+    # movie mdhd
+    mov_duration_sec = mov_mdhd_duration / mov_timescale
+    log.info('movie duration : %s sec / %s min', mov_duration_sec, mov_duration_sec/60)
+    # audio mdhd
+    aac_duration_sec = aac_mdhd_duration / aac_timescale
+    log.info('audio duration : %s sec / %s min', aac_duration_sec, aac_duration_sec/60)
+
+
 def finsta360(
     moov_const,
     src_filename,
     ref_filename=None,
     dst_filename=None,
     keep_temp=False,
-    verbose=False):
+    verbose=False,
+    profile_filename=None,
+    predict=False,
+    split_aac=None,
+    check=False,
+    extract_prefix=None,
+    salvage=False,
+    tables_in=None,
+    tables_out=None,
+    estimate=False,
+    fused=False,
+    trim=None,
+    split=None,
+    reference=False,
+    chapters=None,
+    follow=False):
+
+    if check:
+        # verify mode
+        if profile_filename is None:
+            rules = None
+        else:
+            rules = load_scan_rules(profile_filename)
+        verify_mp4(src_filename, rules, verbose=verbose)
+        return
+
+    if estimate:
+        # estimate mode
+        codec = 'avc1' if ref_filename is None else read_video_codec(ref_filename)
+        if profile_filename is None:
+            rules = default_scan_rules(codec)
+        else:
+            rules = load_scan_rules(profile_filename, codec)
+        estimate_recovery(src_filename, moov_const, rules, verbose=verbose)
+        return
 
     if ref_filename is None:
         # check mode
         print_atoms(src_filename)
         return
 
+    if extract_prefix is not None:
+        # the audio is extracted as AAC frames
+        split_aac = True
+
     # temporary files
     ref_moov_filename = 'finsta360_ref.moov'
     new_moov_filename = 'finsta360_new.moov'
 
-    # 1) extract reference moov
-    print('')
-    print('########################################')
-    print(f'# 1) extracting reference moov from\n\t{ref_filename}')
-    extract_moov(ref_filename, ref_moov_filename)
+    # the source is copied to the output during the scan
+    fused = ((fused or follow) and tables_in is None and extract_prefix is None and trim is None
+             and split is None and not reference and dst_filename is not None)
+    if chapters is None:
+        chapters = []
+
+    # the scan stops at the end of the clip
+    stop_after = None
+    if trim is not None:
+        stop_after = int(math.ceil(trim[1] * moov_const[3] / moov_const[0])) + 1
+
+    # the scan rules are decided from the reference before the stages,
+    # so that 1) and 2) do not depend on each other
+    codec = read_video_codec(ref_filename)
+    print(f'video codec : {codec}')
+    if split_aac is None:
+        # the audio is rebuilt if the reference has the audio track
+        split_aac = has_audio_track(ref_filename)
+    if profile_filename is None:
+        rules = default_scan_rules(codec)
+    else:
+        rules = load_scan_rules(profile_filename, codec)
+    if follow and predict:
+        log.warning('WARNING: -i is not used with -F, whose source is still growing')
     if verbose:
-        print_atoms(ref_moov_filename)
+        print_atoms(ref_filename)
+
+    # 1), 2) and the chapters run concurrently,
+    # so that they write through the logger instead of print(), a record at a time
+
+    def extract_stage():
+        # 1) extract reference moov
+        log.info('\n########################################\n# 1) extracting reference moov from\n\t%s', ref_filename)
+        extract_moov(ref_filename, ref_moov_filename)
+
+    def scan_stage():
+        if tables_in is not None:
+            # 2) loading the sample tables saved by the previous run
+            log.info('\n########################################\n# 2) loading sample tables from\n\t%s', tables_in)
+            tables, header = load_sample_tables(tables_in)
+            if header['source_size'] != os.path.getsize(src_filename):
+                log.warning('WARNING: the tables are recovered from %s of %d bytes',
+                            header['source'], header['source_size'])
+            if header['codec'] != codec:
+                log.warning('WARNING: the tables are recovered for %s', header['codec'])
+        else:
+            # 2) regenerate sample tables from mdat
+            log.info('\n########################################\n# 2) regenerate sample tables from mdat in\n\t%s', src_filename)
+            if follow:
+                log.info('following it until its size is unchanged for %.0f sec', FOLLOW_IDLE)
+                if fused:
+                    log.info('and copying it to\n\t%s', dst_filename)
+                    with open(dst_filename, 'wb') as f_dst:
+                        tables = follow_sample_tables(
+                            src_filename,
+                            rules,
+                            split_aac=split_aac,
+                            salvage=salvage,
+                            copy_to=f_dst,
+                            verbose=verbose)
+                else:
+                    tables = follow_sample_tables(
+                        src_filename,
+                        rules,
+                        split_aac=split_aac,
+                        salvage=salvage,
+                        verbose=verbose)
+            elif fused:
+                log.info('and copying it to\n\t%s', dst_filename)
+                with open(src_filename, 'rb') as f_src:
+                    find_mdat_start(f_src)
+                with open(dst_filename, 'wb') as f_dst:
+                    tables = recover_sample_tables_from_mdat_fast(
+                        src_filename,
+                        rules,
+                        predict=predict,
+                        split_aac=split_aac,
+                        salvage=salvage,
+                        copy_to=f_dst,
+                        stop_after=stop_after,
+                        verbose=verbose)
+            else:
+                tables = recover_sample_tables_from_mdat_fast(
+                    src_filename,
+                    rules,
+                    predict=predict,
+                    split_aac=split_aac,
+                    salvage=salvage,
+                    stop_after=stop_after,
+                    verbose=verbose)
+            if len(tables['skipped']) > 0:
+                skipped_bytes = sum(size for _, size in tables['skipped'])
+                log.info('%d damaged or zero-filled regions (%d bytes) are skipped',
+                         len(tables['skipped']), skipped_bytes)
+            if not split_aac:
+                # the audio runs are not the AAC frames
+                log.info('audio track is skipped')
+                tables['soun'] = []
+        if tables_out is not None:
+            log.info('saving sample tables in\n\t%s', tables_out)
+            save_sample_tables(tables_out, tables, src_filename, codec)
+        if verbose:
+            print_table_durations(moov_const, tables)
+        return tables
 
-    # 2) regenerate sample tables from mdat
-    print('')
-    print('########################################')
-    print(f'# 2) regenerate sample tables from mdat in\n\t{src_filename}')
-    mov_table, aac_table = recover_sample_tables_from_mdat_fast(
-        src_filename,
-        verbose=verbose)
-    if verbose:
-        print(f'number of samples (movie) : {len(mov_table)}')
-        print(f'number of samples (audio) : {len(aac_table)}')
-        # constants
-        # mov_sample_duration = 1001
-        # aac_sample_duration = 1024
-
-        # mvhd_timescale = 48000
-        # mov_timescale = 30000
-        # aac_timescale = 48000
-        mov_sample_duration = moov_const[0]
-        aac_sample_duration = moov_const[1]
-        mvhd_timescale = moov_const[2]
-        mov_timescale = moov_const[3]
-        aac_timescale = moov_const[4]
-
-        n_mov_table = len(mov_table)
-        n_aac_table = len(aac_table)
-
-        mov_mdhd_duration = n_mov_table * mov_sample_duration
-        aac_mdhd_duration = n_aac_table * aac_sample_duration
-        mov_tkhd_duration = int(mov_mdhd_duration * mvhd_timescale / mov_timescale)
-
-        # mvhd
-        mvhd_duration_sec = mov_tkhd_duration / mvhd_timescale
-        print(f'mvhd duration  : {mvhd_duration_sec} sec / {mvhd_duration_sec/60} min')
-        # movie mdhd
-        mov_duration_sec = mov_mdhd_duration / mov_timescale
-        print(f'movie duration : {mov_duration_sec} sec / {mov_duration_sec/60} min')
-        # audio mdhd
-        aac_duration_sec = aac_mdhd_duration / aac_timescale
-        print(f'audio duration : {aac_duration_sec} sec / {aac_duration_sec/60} min')
-
-    # 3) rebuilding moov from the sample tables
-    print('')
-    print('########################################')
-    print(f'# 3) rebuilding moov from the sample tables')
-    recover_moov_from_sample_tables(
-        moov_const,
-        ref_moov_filename,
-        new_moov_filename,
-        mov_table, aac_table,
-        full_copy=True,
-    )
-    if verbose:
-        print_atoms(new_moov_filename)
+    def streams_stage(_, tables):
+        # 3) extracting the elementary streams
+        print('')
+        print('########################################')
+        print(f'# 3) extracting the elementary streams as\n\t{extract_prefix}.*')
+        extract_elementary_streams(
+            src_filename,
+            tables,
+            read_decoder_configs(ref_moov_filename),
+            codec,
+            extract_prefix,
+            verbose=verbose)
+
+    def rebuild_stage(_, tables):
+        # 3) rebuilding moov from the sample tables
+        print('')
+        print('########################################')
+        print(f'# 3) rebuilding moov from the sample tables')
+        recover_moov_from_sample_tables(
+            moov_const,
+            ref_moov_filename,
+            new_moov_filename,
+            tables,
+            full_copy=True,
+            verbose=verbose,
+        )
+        if verbose:
+            print_atoms(new_moov_filename)
 
-    if dst_filename is None:
-        # test mode
+    def merge_stage(_):
+        # 4) merging the rebuilt moov into the source
+        print('')
+        print('########################################')
+        print(f'# 4) merging the rebuilt moov into\n\t{src_filename}\nas\n\t{dst_filename}')
+        if fused:
+            # the source is already copied by the scan
+            with open(src_filename, 'rb') as f_src:
+                mdat_start = find_mdat_start(f_src)
+            with open(dst_filename, 'r+b') as f_dst:
+                append_moov(f_dst, os.path.getsize(src_filename), mdat_start, new_moov_filename)
+        else:
+            merge_moov(
+                src_filename,
+                new_moov_filename,
+                dst_filename,
+            )
+        return [dst_filename]
+
+    def trim_stage(_, tables):
+        # 3) writing the clip
+        print('')
+        print('########################################')
+        print(f'# 3) writing the clip of {trim[0]} - {trim[1]} sec as\n\t{dst_filename}')
+        trim_mp4(
+            moov_const,
+            src_filename,
+            ref_moov_filename,
+            dst_filename,
+            tables,
+            trim[0],
+            trim[1],
+            verbose=verbose)
+        return [dst_filename]
+
+    def split_stage(_, tables):
+        # 3) writing the segments
+        print('')
+        print('########################################')
+        print(f'# 3) writing the segments of\n\t{dst_filename}')
+        return split_mp4(
+            moov_const,
+            src_filename,
+            ref_moov_filename,
+            dst_filename,
+            tables,
+            max_bytes=split[0],
+            max_seconds=split[1],
+            verbose=verbose)
+
+    def chapters_stage():
+        # 2) regenerate sample tables of the following chapters
+        chapter_tables = []
+        for filename in chapters:
+            log.info('\n########################################\n# 2) regenerate sample tables from mdat in\n\t%s', filename)
+            tables = recover_sample_tables_from_mdat_fast(
+                filename,
+                rules,
+                predict=predict,
+                split_aac=split_aac,
+                salvage=salvage,
+                verbose=verbose)
+            if not split_aac:
+                tables['soun'] = []
+            chapter_tables.append((filename, tables))
+        return chapter_tables
+
+    def reference_stage(_, tables, chapter_tables):
+        # 3) writing the reference movie
+        print('')
+        print('########################################')
+        print(f'# 3) writing the reference movie as\n\t{dst_filename}')
+        write_reference_movie(
+            moov_const,
+            ref_moov_filename,
+            dst_filename,
+            [(src_filename, tables)] + chapter_tables,
+            verbose=verbose)
+
+    def verify_stage(filenames):
+        # 5) verifying the output
+        for filename in filenames:
+            print('')
+            print('########################################')
+            print(f'# 5) verifying the sample tables of\n\t{filename}')
+            verify_mp4(filename, rules, verbose=verbose)
+
+    stages = [
+        ('extract', extract_stage, ()),
+        ('scan', scan_stage, ()),
+    ]
+    if extract_prefix is not None:
+        stages.append(('streams', streams_stage, ('extract', 'scan')))
+    elif reference:
+        if dst_filename is None:
+            print('the reference movie needs the output file (-o)')
+            return
+        # the samples are not in the movie, so that it is not verified here
+        stages.append(('chapters', chapters_stage, ()))
+        stages.append(('reference', reference_stage, ('extract', 'scan', 'chapters')))
+    elif trim is not None or split is not None:
+        if dst_filename is None:
+            print('the clip and the segments need the output file (-o)')
+            return
+        if trim is not None:
+            stages.append(('trim', trim_stage, ('extract', 'scan')))
+            stages.append(('verify', verify_stage, ('trim',)))
+        else:
+            stages.append(('split', split_stage, ('extract', 'scan')))
+            stages.append(('verify', verify_stage, ('split',)))
+    else:
+        stages.append(('rebuild', rebuild_stage, ('extract', 'scan')))
+        if dst_filename is not None:
+            stages.append(('merge', merge_stage, ('rebuild',)))
+            stages.append(('verify', verify_stage, ('merge',)))
+
+    try:
+        _, timings = run_stages(stages)
+    finally:
         if not keep_temp:
-            os.remove(ref_moov_filename)
-            os.remove(new_moov_filename)
-        return
+            for filename in (ref_moov_filename, new_moov_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
 
-    # 4) merging the rebuilt moov into the source
     print('')
-    print('########################################')
-    print(f'# 4) merging the rebuilt moov into\n\t{src_filename}\nas\n\t{dst_filename}')
-    merge_moov(
-        src_filename,
-        new_moov_filename,
-        dst_filename,
-    )
-
-
-    if not keep_temp:
-        os.remove(ref_moov_filename)
-        os.remove(new_moov_filename)
+    print_stage_timings(stages, timings)
 
 
 def usage():
@@ -1266,7 +3041,37 @@ def usage():
     print('USAGE: finsta360.py [options]')
     print('\t-s file : source file, that is, corrupted mp4 (insv) file')
     print('\t-r file : complete mp4 (insv) file as a reference')
+    print('\t-L file : library of the references made by library.py,')
+    print('\t          to choose the reference by the parameter sets in the source')
     print('\t-o file : output recovered mp4 (insv) file')
+    print('\t-p file : scanner profile made by learn.py from the reference')
+    print('\t-i      : to predict the sample boundaries from the interleave')
+    print('\t-a      : to split the audio into raw AAC frames')
+    print('\t          (default if the reference has the audio track)')
+    print('\t-A      : to skip the audio track')
+    print('\t-m d_v,d_a,ts_mvhd,ts_v,ts_a')
+    print('\t        : sample durations and timescales of moov')
+    print('\t          (default 3000,1024,90000,90000,48000)')
+    print('\t-f      : to copy the source to the output during the scan,')
+    print('\t          reading the source only once')
+    print('\t-F      : to follow the source while it is being copied, as tail -f,')
+    print('\t          and to finish the output when its size is unchanged for 10 sec')
+    print('\t-T s,e  : to write only the clip from s to e seconds,')
+    print('\t          starting at the sync sample before s')
+    print('\t-S size : to split the output into segments of size bytes (K, M, G suffix)')
+    print('\t-D sec  : to split the output into segments of sec seconds')
+    print('\t          the segments start at sync samples, as out_001.mp4, ...')
+    print('\t-R      : to write only ftyp and moov, referring to the samples in the source')
+    print('\t          instead of copying them')
+    print('\t-C file : following source file, joined to the timeline of the reference movie')
+    print('\t-w file : to save the recovered sample tables')
+    print('\t-t file : to rebuild moov from the saved sample tables without scanning')
+    print('\t-d      : to salvage the damaged source by skipping the broken regions')
+    print('\t-e      : to estimate the recoverable samples and duration')
+    print('\t          by scanning a small fraction of the source')
+    print('\t-c      : to verify the sample tables of the source file against its mdat')
+    print('\t-x name : to extract the video (name.h264) and audio (name.aac) streams')
+    print('\t          instead of rebuilding the moov')
     print('\t-v      : to set verbose mode')
     print('\t-k      : to keep temporary files')
     print('\t          (reference and recovered moov files, finsta360*.moov)')
@@ -1278,7 +3083,24 @@ def usage():
 if __name__ == '__main__':
     src_filename = None
     ref_filename = None
+    library_filename = None
     dst_filename = None
+    profile_filename = None
+    predict = False
+    split_aac = None
+    check = False
+    extract_prefix = None
+    salvage = False
+    tables_in = None
+    tables_out = None
+    moov_const = None
+    estimate = False
+    fused = False
+    trim = None
+    split = None
+    reference = False
+    chapters = []
+    follow = False
     verbose = False
     keep_temp = False
     i = 1
@@ -1289,9 +3111,74 @@ if __name__ == '__main__':
         elif sys.argv[i] == '-r':
             ref_filename = sys.argv[i+1]
             i += 2
+        elif sys.argv[i] == '-L':
+            library_filename = sys.argv[i+1]
+            i += 2
         elif sys.argv[i] == '-o':
             dst_filename = sys.argv[i+1]
             i += 2
+        elif sys.argv[i] == '-p':
+            profile_filename = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-i':
+            predict = True
+            i += 1
+        elif sys.argv[i] == '-a':
+            split_aac = True
+            i += 1
+        elif sys.argv[i] == '-A':
+            split_aac = False
+            i += 1
+        elif sys.argv[i] == '-m':
+            moov_const = tuple(int(x) for x in sys.argv[i+1].split(','))
+            if len(moov_const) != 5: usage()
+            i += 2
+        elif sys.argv[i] == '-w':
+            tables_out = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-t':
+            tables_in = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-d':
+            salvage = True
+            i += 1
+        elif sys.argv[i] == '-f':
+            fused = True
+            i += 1
+        elif sys.argv[i] == '-F':
+            follow = True
+            i += 1
+        elif sys.argv[i] == '-T':
+            trim = tuple(float(x) for x in sys.argv[i+1].split(','))
+            if len(trim) != 2: usage()
+            i += 2
+        elif sys.argv[i] == '-S':
+            units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+            size = sys.argv[i+1]
+            if size[-1].upper() in units:
+                size = int(float(size[:-1]) * units[size[-1].upper()])
+            else:
+                size = int(size)
+            split = (size, None if split is None else split[1])
+            i += 2
+        elif sys.argv[i] == '-D':
+            split = (None if split is None else split[0], float(sys.argv[i+1]))
+            i += 2
+        elif sys.argv[i] == '-R':
+            reference = True
+            i += 1
+        elif sys.argv[i] == '-C':
+            chapters.append(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '-e':
+            estimate = True
+            i += 1
+        elif sys.argv[i] == '-c':
+            check = True
+            i += 1
+        elif sys.argv[i] == '-x':
+            extract_prefix = sys.argv[i+1]
+            i += 2
         elif sys.argv[i] == '-v':
             verbose = True
             i += 1
@@ -1309,12 +3196,31 @@ if __name__ == '__main__':
     if not os.path.exists(src_filename):
         print(f'source file {src_filename} does not exist')
         sys.exit()
+    if ref_filename is None and library_filename is not None:
+        if not os.path.exists(library_filename):
+            print(f'library file {library_filename} does not exist')
+            sys.exit()
+        ref_filename = choose_reference(load_reference_library(library_filename), src_filename)
+        if ref_filename is None:
+            print(f'no reference for {src_filename} is found in {library_filename}')
+            sys.exit()
+        print(f'reference : {ref_filename}')
     if not ref_filename is None and not os.path.exists(ref_filename):
         print(f'reference file {ref_filename} does not exist')
         sys.exit()
     if not dst_filename is None and os.path.exists(dst_filename):
         print(f'output file {dst_filename} already exists')
         sys.exit()
+    for filename in chapters:
+        if not os.path.exists(filename):
+            print(f'source file {filename} does not exist')
+            sys.exit()
+    if not profile_filename is None and not os.path.exists(profile_filename):
+        print(f'profile file {profile_filename} does not exist')
+        sys.exit()
+    if not tables_in is None and not os.path.exists(tables_in):
+        print(f'sample table file {tables_in} does not exist')
+        sys.exit()
 
 
     # constants
@@ -1325,11 +3231,14 @@ if __name__ == '__main__':
     mov_timescale = 90000
     aac_timescale = 48000
 
-    moov_const = (mov_sample_duration,
-                  aac_sample_duration,
-                  mvhd_timescale,
-                  mov_timescale,
-                  aac_timescale)
+    setup_logging(verbose)
+
+    if moov_const is None:
+        moov_const = (mov_sample_duration,
+                      aac_sample_duration,
+                      mvhd_timescale,
+                      mov_timescale,
+                      aac_timescale)
 
 
     # with open('aac.aac', 'rb') as f_in:
@@ -1347,7 +3256,22 @@ if __name__ == '__main__':
         ref_filename,
         dst_filename,
         keep_temp,
-        verbose)
+        verbose,
+        profile_filename,
+        predict,
+        split_aac,
+        check,
+        extract_prefix,
+        salvage,
+        tables_in,
+        tables_out,
+        estimate,
+        fused,
+        trim,
+        split,
+        reference,
+        chapters,
+        follow)
 
 
     sys.exit()
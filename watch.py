@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# watch.py - repair incomplete MP4 (INSV) files copied into watched directories
+#
+# the directories are polled, and the files classified as incomplete
+# by catalog.py (without 'moov') are queued as
+# jobs of finsta360 in a SQLite database, so that the queue survives restarts.
+# jobs run in worker processes, with the limits of the total number of jobs
+# and of the jobs reading from the same disk at the same time.
+import concurrent.futures
+import contextlib
+import hashlib
+import os
+import os.path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from catalog import EXTENSIONS, classify_file
+from mov import finsta360, setup_logging
+
+
+# default constants of moov, see mov.py
+MOOV_CONST = (3000, 1024, 90000, 90000, 48000)
+
+# a file is regarded as copied when its size and mtime are unchanged for this
+STABLE_SECONDS = 10.0
+
+
+def open_db(db_filename):
+    db = sqlite3.connect(db_filename)
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            path    TEXT PRIMARY KEY,
+            size    INTEGER,
+            mtime   REAL,
+            state   TEXT,
+            dst     TEXT,
+            error   TEXT,
+            updated REAL
+        )''')
+    # the jobs interrupted by the previous shutdown are run again
+    db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+    db.commit()
+    return db
+
+
+def set_state(db, path, state, error=None):
+    db.execute('UPDATE jobs SET state = ?, error = ?, updated = ? WHERE path = ?',
+               (state, error, time.time(), path))
+    db.commit()
+
+
+def output_filename(dst_dir, directory, name, n_directories):
+    # with more than one directory, the files of the same name are told apart
+    # by the hash of the directory
+    if n_directories == 1:
+        return os.path.join(dst_dir, name)
+    digest = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:8]
+    root, ext = os.path.splitext(name)
+    return os.path.join(dst_dir, f'{root}_{digest}{ext}')
+
+
+def scan_directories(db, directories, dst_dir, seen):
+    # queue the new incomplete files whose copy is finished
+    # seen keeps (size, mtime, first seen) of the files being copied
+    now = time.time()
+    for directory in directories:
+        for entry in os.scandir(directory):
+            if not entry.is_file(): continue
+            if not entry.name.lower().endswith(EXTENSIONS): continue
+            path = os.path.abspath(entry.path)
+            stat = entry.stat()
+
+            row = db.execute('SELECT size, mtime FROM jobs WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime: continue
+
+            key = (stat.st_size, stat.st_mtime)
+            if path not in seen or seen[path][:2] != key:
+                seen[path] = key + (now,)
+                continue
+            if now - seen[path][2] < STABLE_SECONDS: continue
+            del seen[path]
+
+            status = classify_file(path)['status']
+            if status in ('missing_moov', 'zero_tail', 'truncated_mdat'):
+                state = 'queued'
+            else:
+                state = status
+            dst = output_filename(dst_dir, directory, entry.name, len(directories))
+            db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, NULL, ?)',
+                       (path, stat.st_size, stat.st_mtime, state, dst, now))
+            db.commit()
+            if state == 'queued':
+                print(f'queued : {path}')
+
+
+def run_job(path, ref_filename, dst_filename, moov_const):
+    # in a worker process
+    # finsta360 writes its temporary files in the current directory,
+    # so each job runs in its own directory
+    # the output is written as .part and renamed when it is complete,
+    # so that the partial output of an interrupted job does not block its rerun
+    part_filename = dst_filename + '.part'
+    if os.path.exists(part_filename):
+        os.remove(part_filename)
+    job_dir = tempfile.mkdtemp(prefix='finsta360_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(job_dir)
+        with open(dst_filename + '.log', 'w') as f_log, contextlib.redirect_stdout(f_log):
+            # the stages of finsta360 write through its logger
+            setup_logging()
+            finsta360(moov_const, path, ref_filename, part_filename)
+        os.replace(part_filename, dst_filename)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def disk_of(path):
+    return os.stat(path).st_dev
+
+
+def watch(
+    directories,
+    ref_filename,
+    dst_dir,
+    db_filename='watch.db',
+    max_jobs=2,
+    max_jobs_per_disk=1,
+    interval=5.0,
+    moov_const=MOOV_CONST):
+
+    ref_filename = os.path.abspath(ref_filename)
+    dst_dir = os.path.abspath(dst_dir)
+    db = open_db(db_filename)
+    seen = {}
+
+    # path -> (future, disk)
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_jobs) as executor:
+        while True:
+            scan_directories(db, directories, dst_dir, seen)
+
+            # collect the finished jobs
+            for path, (future, disk) in list(running.items()):
+                if not future.done(): continue
+                del running[path]
+                error = future.exception()
+                if error is None:
+                    set_state(db, path, 'done')
+                    print(f'done   : {path}')
+                else:
+                    set_state(db, path, 'failed', str(error))
+                    print(f'failed : {path} ({error})')
+
+            # start the queued jobs within the limits
+            busy = {}
+            for future, disk in running.values():
+                busy[disk] = busy.get(disk, 0) + 1
+            queued = db.execute(
+                "SELECT path, dst FROM jobs WHERE state = 'queued' ORDER BY updated").fetchall()
+            for path, dst in queued:
+                if len(running) >= max_jobs: break
+                if not os.path.exists(path):
+                    set_state(db, path, 'failed', 'source file is removed')
+                    continue
+                disk = disk_of(path)
+                if busy.get(disk, 0) >= max_jobs_per_disk: continue
+                busy[disk] = busy.get(disk, 0) + 1
+                future = executor.submit(run_job, path, ref_filename, dst, moov_const)
+                running[path] = (future, disk)
+                set_state(db, path, 'running')
+                print(f'start  : {path}')
+
+            time.sleep(interval)
+
+
+def usage():
+    print('watch.py : to repair incomplete MP4 (insv) files copied into the directories')
+    print('USAGE: watch.py [options] dir [dir ...]')
+    print('\t-r file : complete mp4 (insv) file as a reference')
+    print('\t-o dir  : directory for the recovered files')
+    print('\t-b file : job database (default watch.db)')
+    print('\t-j n    : number of jobs at the same time (default 2)')
+    print('\t-J n    : number of jobs reading the same disk at the same time (default 1)')
+    sys.exit()
+
+
+if __name__ == '__main__':
+    ref_filename = None
+    dst_dir = None
+    db_filename = 'watch.db'
+    max_jobs = 2
+    max_jobs_per_disk = 1
+    directories = []
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '-r':
+            ref_filename = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-o':
+            dst_dir = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-b':
+            db_filename = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-j':
+            max_jobs = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '-J':
+            max_jobs_per_disk = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i].startswith('-'):
+            usage()
+        else:
+            directories.append(sys.argv[i])
+            i += 1
+
+    if ref_filename is None or dst_dir is None or len(directories) == 0:
+        usage()
+    if not os.path.exists(ref_filename):
+        print(f'reference file {ref_filename} does not exist')
+        sys.exit()
+    for directory in directories + [dst_dir]:
+        if not os.path.isdir(directory):
+            print(f'directory {directory} does not exist')
+            sys.exit()
+
+    watch(directories, ref_filename, dst_dir, db_filename, max_jobs, max_jobs_per_disk)